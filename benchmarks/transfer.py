@@ -0,0 +1,266 @@
+"""
+Benchmark the FTP to S3 transfer paths in `khp.ftp` against local stand-ins:
+an implicit TLS FTP server (pyftpdlib) and an in-process S3 mock (moto).
+
+Synthetic CSI/FTCI reports are generated, then each mode is timed end to end
+(FTP listing, transfer and upload to S3), reporting files/sec, MB/sec and TLS
+handshake counts. Requires pyftpdlib, pyopenssl and moto, plus a
+`khp/config/private.yml` (its ftp and aws values are overridden here).
+
+Usage, from the root of the repository:
+
+    PYTHONPATH=. python benchmarks/transfer.py --files 200 --size-kb 64 \
+        --connections 4
+"""
+
+import argparse
+import asyncio
+from collections import Counter
+import datetime
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+import boto3
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from moto import mock_aws
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import TLS_FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+from khp import async_ftp, config, ftp, utils
+from khp import ftplib_mod as ftplib
+from khp.implicitly_tls import tyFTP
+
+LOGGER = logging.getLogger(__name__)
+
+FOLDER = 'bench'
+S3_BUCKET = 'khp-bench'
+USER = 'khp'
+PASSWORD = 'khp'
+
+class BaselineFTP(tyFTP):
+    """`tyFTP` as it was before data connections resumed the TLS session of
+    the control connection, so every transfer makes a full handshake."""
+
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size = ftplib.FTP.ntransfercmd(self, cmd, rest)
+        if self._prot_p:
+            conn = self.context.wrap_socket(conn, server_hostname=self.host)
+            self._count_handshake(conn)
+        return conn, size
+
+class ImplicitTLSHandler(TLS_FTPHandler):
+    """pyftpdlib handler that secures the control connection on accept,
+    like the KHP server, rather than waiting for AUTH TLS."""
+
+    def handle(self):
+        self.secure_connection(self.ssl_context)
+
+    def handle_ssl_established(self):
+        TLS_FTPHandler.handle(self)
+
+def write_certificate(directory):
+    """Write a self-signed certificate and key for the local FTP server.
+
+    Returns:
+        str: Path of the certificate
+        str: Path of the key
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.utcnow()
+    cert = (x509.CertificateBuilder()
+            .subject_name(name).issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now)
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256()))
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    with open(certfile, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, 'wb') as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption()))
+    return certfile, keyfile
+
+def start_ftp_server(root, certfile, keyfile):
+    """Serve `root` over implicit TLS on a free local port.
+
+    Returns:
+        pyftpdlib.servers.ThreadedFTPServer: The running server
+    """
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(USER, PASSWORD, root, perm='elr')
+    ImplicitTLSHandler.certfile = certfile
+    ImplicitTLSHandler.keyfile = keyfile
+    ImplicitTLSHandler.authorizer = authorizer
+    ImplicitTLSHandler.tls_data_required = True
+    server = ThreadedFTPServer(('127.0.0.1', 0), ImplicitTLSHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def generate_reports(directory, count, size_kb):
+    """Generate synthetic pipe-delimited reports, alternating between CSI
+    (V1) and FTCI (V2) files.
+
+    Args:
+        directory (str): Directory to write the reports to
+        count (int): Number of reports
+        size_kb (int): Approximate size of each report, in KB
+
+    Returns:
+        int: Total bytes generated
+    """
+    start = datetime.datetime(2018, 10, 1)
+    total = 0
+    for index in range(count):
+        prefix = 'V1' if index % 2 == 0 else 'V2'
+        lines = []
+        size = 0
+        while size < size_kb * 1024:
+            dt = start + datetime.timedelta(seconds=random.randint(0, 86400))
+            if prefix == 'V1':
+                line = '{:%Y-%m-%d %H:%M:%S}|{}|CSI{}|{}\r\n'.format(
+                    dt, random.choice([6007, 6008, 6020, 6021]),
+                    random.randint(1, 20), random.randint(0, 500))
+            else:
+                line = '{}|{}|{}|{:%Y-%m-%d %H:%M:%S}\r\n'.format(
+                    random.randint(1000, 1100), random.randint(1, 20),
+                    random.randint(1, 20), dt)
+            lines.append(line)
+            size += len(line)
+        filename = '{}_{:%Y%m%d}_{:05d}.txt'.format(prefix, start, index)
+        with open(os.path.join(directory, filename), 'w') as f:
+            f.write(''.join(lines))
+        total += size
+    return total
+
+def reset(output_dir):
+    """Empty the S3 bucket, its key manifest and the local output directory
+    between runs."""
+    bucket = boto3.resource('s3').Bucket(S3_BUCKET)
+    bucket.objects.all().delete()
+    key_manifest = config.S3_KEY_MANIFEST_PATH.format(bucket=S3_BUCKET)
+    if os.path.exists(key_manifest):
+        os.remove(key_manifest)
+    for filename in os.listdir(output_dir):
+        os.remove(os.path.join(output_dir, filename))
+
+def run_sequential(connections, compression):
+    """The original path: a single session without TLS session resumption,
+    with each file retrieved in turn, then uploaded to S3 one at a time."""
+    ftp_conf = config.CONFIG['ftp']
+    with BaselineFTP(context=ftp.SSL_CONTEXT) as session:
+        session.connect(host=ftp_conf['host'], port=ftp_conf['port'])
+        session.login(user=ftp_conf['user'], passwd=ftp_conf['pwd'])
+        session.prot_p()
+        session.cwd(FOLDER)
+        for filename in ftp.list_files(session):
+            output_file = os.path.join(config.FTP_OUTPUT_DIR, filename)
+            with open(output_file, 'wb') as f:
+                session.retrbinary('RETR ' + filename, f.write, 8 * 1024)
+    utils.upload_to_s3(S3_BUCKET, utils.search_path(config.FTP_OUTPUT_DIR),
+                       compression=compression, max_workers=1)
+    return session.handshakes
+
+def run_download(connections, compression):
+    with ftp.FTPPool(connections, FOLDER) as pool:
+        ftp.download(FOLDER, config.FTP_OUTPUT_DIR, pool=pool)
+        ftp.load_to_s3(compression=compression)
+        return pool.handshakes
+
+def run_stream(connections, compression):
+    with ftp.FTPPool(connections, FOLDER) as pool:
+        ftp.transfer_to_s3(FOLDER, S3_BUCKET, compression=compression,
+                           pool=pool)
+        return pool.handshakes
+
+def run_async(connections, compression):
+    handshakes = Counter()
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(async_ftp.download(
+            FOLDER, config.FTP_OUTPUT_DIR, max_connections=connections,
+            handshakes=handshakes))
+    finally:
+        loop.close()
+    ftp.load_to_s3(compression=compression)
+    return handshakes
+
+MODES = {
+    'sequential': run_sequential,
+    'parallel': run_download,
+    'stream': run_stream,
+    'async': run_async,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=100,
+                        help='number of synthetic reports')
+    parser.add_argument('--size-kb', type=int, default=64,
+                        help='approximate size of each report, in KB')
+    parser.add_argument('--connections', type=int,
+                        default=config.FTP_MAX_CONNECTIONS,
+                        help='FTP sessions for the concurrent modes')
+    parser.add_argument('--compression', choices=['gzip', 'zstd'],
+                        default=None, help='compress objects on upload')
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES),
+                        default=['sequential', 'parallel', 'stream', 'async'])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix='khp-bench-')
+    try:
+        root = os.path.join(workdir, 'ftp')
+        output_dir = os.path.join(workdir, 'output')
+        os.makedirs(os.path.join(root, FOLDER))
+        os.makedirs(output_dir)
+        total = generate_reports(os.path.join(root, FOLDER), args.files,
+                                 args.size_kb)
+        server = start_ftp_server(root, *write_certificate(workdir))
+        host, port = server.address[:2]
+
+        config.CONFIG['ftp'] = {'host': host, 'port': port, 'user': USER,
+                                'pwd': PASSWORD}
+        config.FTP_OUTPUT_DIR = output_dir
+        config.FTP_MANIFEST_PATH = os.path.join(workdir, 'manifest.json')
+        config.S3_KEY_MANIFEST_PATH = os.path.join(workdir,
+                                                   's3_keys_{bucket}.json')
+        ftp.S3_BUCKET = S3_BUCKET
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+        print("{} files, {:.1f} MB, {} connections, compression: {}".format(
+            args.files, total / 1e6, args.connections, args.compression))
+        print("{:<12}{:>10}{:>12}{:>10}{:>12}{:>10}".format(
+            'mode', 'seconds', 'files/sec', 'MB/sec', 'resumed', 'full'))
+        with mock_aws():
+            boto3.client('s3').create_bucket(Bucket=S3_BUCKET)
+            for mode in args.modes:
+                reset(output_dir)
+                start = time.time()
+                handshakes = MODES[mode](args.connections, args.compression)
+                elapsed = time.time() - start
+                print("{:<12}{:>10.2f}{:>12.1f}{:>10.2f}{:>12}{:>10}".format(
+                    mode, elapsed, args.files / elapsed, total / 1e6 / elapsed,
+                    handshakes['resumed'] if handshakes else '-',
+                    handshakes['full'] if handshakes else '-'))
+        server.close_all()
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+"""
+Asyncio client for the KHP FTP server, with the same implicit TLS behaviour as
+`khp.implicitly_tls.tyFTP`. Listing and retrievals for several sessions run
+concurrently on a single event loop, so FTP transfers can be overlapped with
+other I/O (Icescape, S3) without adding threads.
+
+Example:
+
+>>> import asyncio
+>>> from khp import async_ftp, config
+>>> asyncio.get_event_loop().run_until_complete(
+...     async_ftp.download('CSI_files', config.FTP_OUTPUT_DIR))
+"""
+
+import asyncio
+from collections import Counter
+import logging
+import os
+import time
+
+from khp import config
+from khp import ftp
+from khp import ftplib_mod as ftplib
+
+LOG = logging.getLogger(__name__)
+CONF = config.CONFIG
+
+class _ResumingContext():
+    """An SSL context whose connections offer a TLS session for resumption.
+    asyncio has no way to pass a session when opening a connection, so the
+    session is added where asyncio creates its SSL objects, in `wrap_bio`.
+    Everything else is delegated to the wrapped context.
+    """
+
+    def __init__(self, context, session):
+        self._context = context
+        self._session = session
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+                 server_hostname=None, session=None):
+        return self._context.wrap_bio(incoming, outgoing,
+                                      server_side=server_side,
+                                      server_hostname=server_hostname,
+                                      session=session or self._session)
+
+class AsyncFTP():
+    """An asyncio FTP client for servers using implicit TLS. The control
+    connection is secured as soon as it is opened and, after `prot_p`, every
+    data connection is too. Like `khp.implicitly_tls.tyFTP`, data
+    connections resume the TLS session of the control connection.
+
+    Attributes:
+        context (ssl.SSLContext): SSL context used for all connections
+        timeout (int): Seconds to wait for any single network operation
+        host (str): Host of the FTP server
+        welcome (str): Welcome message sent by the server
+        handshakes (collections.Counter): Number of `full` and `resumed` TLS
+            handshakes performed by this session
+    """
+    encoding = "latin-1"
+
+    def __init__(self, context=None, timeout=60):
+        self.context = context or ftp.SSL_CONTEXT
+        self.timeout = timeout
+        self.host = None
+        self.welcome = None
+        self.handshakes = Counter()
+        self._reader = None
+        self._writer = None
+        self._prot_p = False
+
+    async def _wait(self, coro):
+        return await asyncio.wait_for(coro, self.timeout)
+
+    def _count_handshake(self, writer):
+        sock = writer.get_extra_info('ssl_object')
+        kind = 'resumed' if sock.session_reused else 'full'
+        self.handshakes[kind] += 1
+        LOG.debug("TLS handshake on %s connection: %s",
+                  'data' if writer is not self._writer else 'control', kind)
+
+    async def connect(self, host, port):
+        """Connect to the FTP host over implicit TLS.
+
+        Args:
+            host (str): hostname to connect to
+            port (int): port to connect to
+
+        Returns:
+            str: Welcome message from the server
+        """
+        self.host = host
+        self._reader, self._writer = await self._wait(asyncio.open_connection(
+            host, port, ssl=self.context, server_hostname=host))
+        self._count_handshake(self._writer)
+        self.welcome = await self.getresp()
+        return self.welcome
+
+    async def _getline(self):
+        line = await self._wait(self._reader.readline())
+        if not line:
+            raise EOFError
+        return line.decode(self.encoding).rstrip('\r\n')
+
+    async def getresp(self):
+        """Read a (possibly multi-line) response from the server.
+
+        Returns:
+            str: The response
+
+        Raises:
+            khp.ftplib_mod.error_temp: If the response is a 4xx error
+            khp.ftplib_mod.error_perm: If the response is a 5xx error
+            khp.ftplib_mod.error_proto: If the response is malformed
+        """
+        resp = await self._getline()
+        if resp[3:4] == '-':
+            code = resp[:3]
+            while True:
+                line = await self._getline()
+                resp = resp + '\n' + line
+                if line[:3] == code and line[3:4] != '-':
+                    break
+        if resp[:1] in {'1', '2', '3'}:
+            return resp
+        if resp[:1] == '4':
+            raise ftplib.error_temp(resp)
+        if resp[:1] == '5':
+            raise ftplib.error_perm(resp)
+        raise ftplib.error_proto(resp)
+
+    async def sendcmd(self, cmd):
+        """Send a command and return the response."""
+        self._writer.write((cmd + ftplib.CRLF).encode(self.encoding))
+        await self._wait(self._writer.drain())
+        return await self.getresp()
+
+    async def voidcmd(self, cmd):
+        """Send a command and expect a 2xx response."""
+        resp = await self.sendcmd(cmd)
+        if resp[:1] != '2':
+            raise ftplib.error_reply(resp)
+        return resp
+
+    async def login(self, user, passwd):
+        """Log in to the server.
+
+        Args:
+            user (str): username
+            passwd (str): password
+        """
+        resp = await self.sendcmd('USER ' + user)
+        if resp[:1] == '3':
+            resp = await self.sendcmd('PASS ' + passwd)
+        if resp[:1] != '2':
+            raise ftplib.error_reply(resp)
+        return resp
+
+    async def prot_p(self):
+        """Set up secure data connections."""
+        await self.voidcmd('PBSZ 0')
+        resp = await self.voidcmd('PROT P')
+        self._prot_p = True
+        return resp
+
+    async def cwd(self, dirname):
+        """Change to a directory on the server."""
+        return await self.voidcmd('CWD ' + dirname)
+
+    async def _transfer(self, cmd, rest=None):
+        """Open a passive data connection and start a transfer command.
+
+        The data connection is opened alongside sending the command, since
+        some servers only accept (and start TLS on) the data connection after
+        the command has been received.
+
+        Returns:
+            asyncio.StreamReader: Reader for the data connection
+            asyncio.StreamWriter: Writer for the data connection
+        """
+        host, port = ftplib.parse227(await self.sendcmd('PASV'))
+        if self._prot_p:
+            session = self._writer.get_extra_info('ssl_object').session
+            opening = asyncio.ensure_future(asyncio.open_connection(
+                host, port, ssl=_ResumingContext(self.context, session),
+                server_hostname=self.host))
+        else:
+            opening = asyncio.ensure_future(asyncio.open_connection(host, port))
+        try:
+            if rest is not None:
+                await self.sendcmd("REST %s" % rest)
+            resp = await self.sendcmd(cmd)
+            if resp[:1] == '2':
+                resp = await self.getresp()
+            if resp[:1] != '1':
+                raise ftplib.error_reply(resp)
+            reader, writer = await self._wait(opening)
+        except BaseException:
+            opening.cancel()
+            raise
+        if self._prot_p:
+            self._count_handshake(writer)
+        return reader, writer
+
+    async def retrbinary(self, cmd, callback, blocksize=8192, rest=None):
+        """Retrieve data in binary mode.
+
+        Args:
+            cmd (str): A RETR command
+            callback (function): Called with each block of data read
+            blocksize (:obj:`int`, optional): Maximum bytes read at once
+            rest (:obj:`int`, optional): Offset to restart the transfer at
+
+        Returns:
+            str: The final response from the server
+        """
+        await self.voidcmd('TYPE I')
+        reader, writer = await self._transfer(cmd, rest)
+        try:
+            while True:
+                data = await self._wait(reader.read(blocksize))
+                if not data:
+                    break
+                callback(data)
+        finally:
+            writer.close()
+        return await self.getresp()
+
+    async def retrlines(self, cmd):
+        """Retrieve data in line mode.
+
+        Args:
+            cmd (str): A RETR, LIST, MLSD or NLST command
+
+        Returns:
+            list: Lines of the response, with trailing CRLF stripped
+        """
+        await self.voidcmd('TYPE A')
+        reader, writer = await self._transfer(cmd)
+        lines = []
+        try:
+            while True:
+                line = await self._wait(reader.readline())
+                if not line:
+                    break
+                lines.append(line.decode(self.encoding).rstrip('\r\n'))
+        finally:
+            writer.close()
+        await self.getresp()
+        return lines
+
+    async def list_entries(self):
+        """List the files in the current folder, with their size and
+        modification time. See `khp.ftp.list_entries`.
+
+        Returns:
+            dict: Facts for each file, keyed by filename
+        """
+        try:
+            await self.sendcmd("OPTS MLST type;size;modify;")
+            listing = []
+            for line in await self.retrlines('MLSD'):
+                facts_found, _, name = line.partition(' ')
+                facts = dict(fact.partition('=')[::2] for fact in
+                             facts_found[:-1].lower().split(';'))
+                listing.append((name, facts))
+        except ftplib.error_perm:
+            LOG.debug("MLSD not supported, falling back to LIST")
+            listing = [ftp.parse_list_line(line)
+                       for line in await self.retrlines('LIST')]
+        return {name: {'size': facts.get('size'), 'modify': facts.get('modify')}
+                for name, facts in listing
+                if facts.get('type', 'file') == 'file'}
+
+    async def quit(self):
+        """Quit and close the connection."""
+        try:
+            return await self.voidcmd('QUIT')
+        finally:
+            self.close()
+
+    def close(self):
+        """Close the connection without sending QUIT."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+async def connect(folder=None):
+    """Open an authenticated asyncio session with the KHP FTP server, with a
+    secure (PROT P) data connection.
+
+    Args:
+        folder (:obj:`str`, optional): Folder to switch into
+
+    Returns:
+        AsyncFTP: Logged in FTP session
+    """
+    ftp_conf = CONF['ftp']
+    session = AsyncFTP()
+    LOG.debug("Connecting to host %s", ftp_conf['host'])
+    await session.connect(ftp_conf['host'], ftp_conf['port'])
+    await session.login(ftp_conf['user'], ftp_conf['pwd'])
+    await session.prot_p()
+    if folder:
+        await session.cwd(folder)
+    return session
+
+async def retrieve(session, filename, output_dir):
+    """Download a single file from the current folder of a session.
+
+    Args:
+        session (AsyncFTP): Logged in FTP session
+        filename (str): Name of the file to download
+        output_dir (str): Directory to write the file to
+
+    Returns:
+        int: Number of bytes downloaded
+    """
+    LOG.debug("Writing file %s", filename)
+    output_file = os.path.join(output_dir, filename)
+    with open(output_file, "wb") as f:
+        await session.retrbinary("RETR " + filename, f.write, 64*1024)
+    return os.path.getsize(output_file)
+
+async def download(folder, output_dir, max_connections=1, handshakes=None):
+    """Download files from a folder within the KHP FTP server, the asyncio
+    equivalent of `khp.ftp.download`. Up to `max_connections` sessions are
+    opened, and files are retrieved over all of them concurrently.
+
+    Args:
+        folder (str): folder to download files from
+        output_dir (str): directory to write the files to
+        max_connections (:obj:`int`, optional): Maximum number of concurrent
+            FTP sessions. Defaults to 1.
+        handshakes (:obj:`collections.Counter`, optional): Counter the
+            `full` and `resumed` TLS handshakes of the sessions are added to.
+            Defaults to None.
+
+    Returns:
+        list: Filenames downloaded
+    """
+    LOG.info('Downloading files from FTP folder %s with up to %s connections',
+             folder, max_connections)
+    start = time.time()
+    listing = asyncio.get_event_loop().create_future()
+    pending = asyncio.Queue()
+    counted = Counter()
+
+    async def worker(lister):
+        # the first worker lists the folder while the others log in
+        session = None
+        nbytes = 0
+        try:
+            session = await connect(folder)
+            if lister:
+                filenames = sorted(await session.list_entries())
+                LOG.debug('%s files found in folder %s', len(filenames),
+                          folder)
+                for filename in filenames:
+                    pending.put_nowait(filename)
+                listing.set_result(filenames)
+            await listing
+            while not pending.empty():
+                nbytes += await retrieve(session, pending.get_nowait(),
+                                         output_dir)
+        except Exception as err:
+            if lister and not listing.done():
+                listing.set_exception(err)
+            raise
+        finally:
+            if session is not None:
+                try:
+                    await session.quit()
+                except ftplib.all_errors:
+                    session.close()
+                counted.update(session.handshakes)
+        return nbytes
+
+    sizes = await asyncio.gather(*[worker(index == 0)
+                                   for index in range(max_connections)])
+    filenames = listing.result()
+
+    elapsed = time.time() - start
+    LOG.info("Downloaded %s files (%s bytes) from %s in %.2fs (%.2f MB/s)",
+             len(filenames), sum(sizes), folder, elapsed,
+             sum(sizes) / 1e6 / max(elapsed, 1e-6))
+    LOG.info("TLS handshakes: %s resumed, %s full", counted['resumed'],
+             counted['full'])
+    if handshakes is not None:
+        handshakes.update(counted)
+    return filenames
@@ -0,0 +1,177 @@
+"""
+Compaction of small report objects in S3. CSI reports arrive every 10 minutes,
+each as its own small object, so reading back a day of them costs one request
+per report. Compacting a day merges its reports into a single compressed
+object that loaders can fetch with two requests.
+
+A compacted day is stored under ``compacted/<type>/<YYYY>/<MM>/<DD>/`` as two
+objects: the concatenated reports, and a json index of the key, offset and
+length of each report within the (uncompressed) data. Reports compacted
+earlier keep their offsets when a day is compacted again, so a reader holding
+an older index can still split the newer data.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+
+from khp import config
+from khp import utils
+
+LOGGER = logging.getLogger(__name__)
+
+COMPACTED_PREFIX = 'compacted/'
+INDEX_NAME = 'index.json'
+
+def compacted_keys(report_type, day):
+    """Get the keys of the compacted objects for a day of reports.
+
+    Args:
+        report_type (str): Type of the reports, e.g. V1
+        day (datetime.date): Date of the reports
+
+    Returns:
+        str: Key of the compacted data, e.g.
+            ``compacted/V1/2018/10/01/V1_20181001.txt``
+        str: Key of its index
+    """
+    prefix = COMPACTED_PREFIX + utils.partition_prefix(report_type, day)
+    return (prefix + '{0}_{1:%Y%m%d}.txt'.format(report_type, day),
+            prefix + INDEX_NAME)
+
+def read_index(s3_bucket, report_type, day):
+    """Read the index of a compacted day of reports.
+
+    Args:
+        s3_bucket (str): Name of the S3 bucket
+        report_type (str): Type of the reports, e.g. V1
+        day (datetime.date): Date of the reports
+
+    Returns:
+        dict: The ``key`` of the compacted data and its ``reports``, a list
+        of dicts with the ``key``, ``offset`` and ``length`` of each report.
+        None if the day has not been compacted.
+    """
+    _, index_key = compacted_keys(report_type, day)
+    try:
+        contents = utils.read_s3_bytes(s3_bucket, index_key)
+    except utils.s3_client().exceptions.NoSuchKey:
+        return None
+    return json.loads(contents.decode('utf-8'))
+
+def _split(data, index):
+    """Split compacted data back into its reports, keyed by S3 key."""
+    return {report['key']: data[report['offset']:
+                                report['offset'] + report['length']]
+            for report in index['reports']}
+
+def _read_keys(s3_bucket, keys, max_workers):
+    """Read several S3 objects concurrently, keyed by S3 key."""
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        contents = executor.map(
+            lambda key: utils.read_s3_bytes(s3_bucket, key), keys)
+        return dict(zip(keys, contents))
+
+def _delete_keys(s3_bucket, keys):
+    """Delete S3 objects, in batches of the maximum allowed per request."""
+    for chunk in utils.chunker(sorted(keys), 1000):
+        utils.s3_client().delete_objects(
+            Bucket=s3_bucket,
+            Delete={'Objects': [{'Key': key} for key in chunk]})
+    LOGGER.info("Deleted %s compacted reports from S3 bucket %s", len(keys),
+                s3_bucket)
+
+def compact(s3_bucket, report_type, day, keys, compression='gzip',
+            max_workers=config.S3_UPLOAD_WORKERS, delete_sources=False):
+    """Compact a day of reports into a single object. If the day was already
+    compacted, only reports missing from the compacted object are read, and
+    they are appended to it.
+
+    Args:
+        s3_bucket (str): Name of the S3 bucket
+        report_type (str): Type of the reports, e.g. V1
+        day (datetime.date): Date of the reports
+        keys (list): Keys of the day's reports
+        compression (:obj:`str`, optional): Compression of the compacted
+            object, one of `utils.COMPRESSIONS`. Defaults to gzip.
+        max_workers (:obj:`int`, optional): Number of reports read at once.
+            Defaults to `config.S3_UPLOAD_WORKERS`.
+        delete_sources (:obj:`bool`, optional): Delete the reports in `keys`
+            once the index covering them is written. Defaults to False.
+
+    Returns:
+        dict: Index of the compacted object, see `read_index`. None if there
+        are no reports to compact.
+    """
+    data_key, index_key = compacted_keys(report_type, day)
+    index = read_index(s3_bucket, report_type, day)
+    compacted = {}
+    if index is not None:
+        new_keys = sorted(set(keys) - {report['key']
+                                       for report in index['reports']})
+        if not new_keys:
+            LOGGER.info("%s reports for %s are already compacted",
+                        report_type, day)
+            if delete_sources and keys:
+                _delete_keys(s3_bucket, keys)
+            return index
+        compacted = _split(utils.read_s3_bytes(s3_bucket, index['key']),
+                           index)
+        order = [report['key'] for report in index['reports']] + new_keys
+    else:
+        new_keys = order = sorted(set(keys))
+    if not order:
+        LOGGER.warning("No %s reports to compact for %s", report_type, day)
+        return None
+
+    LOGGER.info("Compacting %s new %s reports for %s into %s", len(new_keys),
+                report_type, day, data_key)
+    compacted.update(_read_keys(s3_bucket, new_keys, max_workers))
+    reports = []
+    offset = 0
+    with utils.S3MultipartWriter(s3_bucket, data_key,
+                                 compression=compression) as writer:
+        for key in order:
+            writer.write(compacted[key])
+            reports.append({'key': key, 'offset': offset,
+                            'length': len(compacted[key])})
+            offset += len(compacted[key])
+    index = {'key': data_key, 'reports': reports}
+    # the index is written last, so it never refers to reports missing from
+    # the data
+    utils.s3_client().put_object(
+        Bucket=s3_bucket, Key=index_key, Body=json.dumps(index).encode('utf-8'),
+        ServerSideEncryption='AES256')
+
+    if delete_sources and keys:
+        _delete_keys(s3_bucket, keys)
+    return index
+
+def read_reports(s3_bucket, report_type, day, keys=None,
+                 max_workers=config.S3_UPLOAD_WORKERS):
+    """Read a day of reports, from the compacted object when there is one.
+    Reports in `keys` that are not in the compacted object, for example ones
+    uploaded after the day was compacted, are read individually.
+
+    Args:
+        s3_bucket (str): Name of the S3 bucket
+        report_type (str): Type of the reports, e.g. V1
+        day (datetime.date): Date of the reports
+        keys (:obj:`list`, optional): Keys of the day's reports. Defaults to
+            None, only reading the compacted object.
+        max_workers (:obj:`int`, optional): Number of reports read at once.
+            Defaults to `config.S3_UPLOAD_WORKERS`.
+
+    Returns:
+        dict: Contents of each report, keyed by S3 key
+    """
+    reports = {}
+    index = read_index(s3_bucket, report_type, day)
+    if index is not None:
+        reports = _split(utils.read_s3_bytes(s3_bucket, index['key']), index)
+    missing = [key for key in keys or [] if key not in reports]
+    if missing:
+        LOGGER.debug("Reading %s uncompacted %s reports for %s", len(missing),
+                     report_type, day)
+        reports.update(_read_keys(s3_bucket, missing, max_workers))
+    return {key: reports[key].decode('utf-8') for key in sorted(reports)}
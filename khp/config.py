@@ -14,11 +14,15 @@ CURR_DIR = os.path.dirname(os.path.realpath(__file__))
 CONFIG_DIR = os.path.join(CURR_DIR, 'config')
 FTP_OUTPUT_DIR = os.path.join(CURR_DIR, 'output', 'ftp')
 ICESCAPE_OUTPUT_DIR = os.path.join(CURR_DIR, 'output', 'icescape')
+MANIFEST_DIR = os.path.join(CURR_DIR, 'output', 'manifests')
+PARQUET_OUTPUT_DIR = os.path.join(CURR_DIR, 'output', 'parquet')
 LOGGING_DIR = os.path.join(CURR_DIR, 'output', 'logs')
 
 CONFIG_PATH = os.path.join(CONFIG_DIR, 'private.yml')
 TRANSFORMS_PATH = os.path.join(CONFIG_DIR, 'transforms.yml')
 LOGGING_PATH = os.path.join(CONFIG_DIR, 'logging.yml')
+FTP_MANIFEST_PATH = os.path.join(MANIFEST_DIR, 'ftp.json')
+S3_KEY_MANIFEST_PATH = os.path.join(MANIFEST_DIR, 's3_keys_{bucket}.json')
 
 ## Initialize logging
 def init_logging():
@@ -42,6 +46,68 @@ API_TIMEZONE = "UTC"
 ## Icescape API constants
 MAX_RESULTS = 10000
 
+## FTP constants
+# maximum number of concurrent sessions to open against the KHP FTP server
+FTP_MAX_CONNECTIONS = 4
+# size of the preallocated receive buffer used for FTP downloads, in bytes
+FTP_BLOCKSIZE = 1024 * 1024
+# number of times to retry (resume) a failed transfer, and the base wait
+# between attempts in seconds
+FTP_RETRIES = 3
+FTP_RETRY_WAIT = 5
+# seconds between polls of the CSI folder, and between keepalive NOOPs when
+# running as a resident poller
+FTP_POLL_INTERVAL = 600
+FTP_KEEPALIVE_INTERVAL = 60
+
+## S3 constants
+# compression applied to reports uploaded to S3, one of None, 'gzip' or
+# 'zstd' (requires the zstandard package). Reads decompress transparently.
+S3_COMPRESSION = None
+# store reports under type/YYYY/MM/DD/ partitions rather than at the root of
+# the bucket, see utils.s3_key
+S3_PARTITIONED = False
+# number of files uploaded to S3 concurrently
+S3_UPLOAD_WORKERS = 8
+# number of reports read from S3 ahead of the Postgres loaders
+S3_PREFETCH_DEPTH = 8
+# HTTP connections kept open by the shared S3 client, at least one per upload
+# worker and prefetched report
+S3_MAX_POOL_CONNECTIONS = 32
+# seconds before the local manifest of S3 keys is reconciled against a full
+# listing of the bucket
+S3_RECONCILE_INTERVAL = 24 * 60 * 60
+
+## Database constants
+# number of reports bulk loaded per transaction
+DB_BATCH_SIZE = 50
+# bytes of a report parsed and copied into Postgres at a time, so memory use
+# does not grow with the size of the report
+DB_LOAD_BLOCK_SIZE = 8 * 1024 * 1024
+# loads of at least this many reports drop the secondary indexes of the table
+# and rebuild them once loaded, rather than updating them row by row
+DB_DEFER_INDEXES_MIN_REPORTS = 500
+# connections kept open by the shared pool, and the most it opens at once
+DB_POOL_MIN_SIZE = 1
+DB_POOL_MAX_SIZE = 20
+# seconds before an idle connection beyond DB_POOL_MIN_SIZE is closed
+DB_POOL_MAX_IDLE = 600
+# seconds to wait for a free connection, None to wait forever
+DB_POOL_TIMEOUT = None
+# number of rows fetched at once when streaming query results
+DB_STREAM_BATCH_SIZE = 10000
+
+## Stat constants
+# file name prefixes of the agent (ADR) and contact (CDR) event reports
+STAT_ADR_PREFIX = 'ADR'
+STAT_CDR_PREFIX = 'CDR'
+
+## Parquet constants
+# also export loaded reports as date-partitioned parquet files, locally and to
+# S3 (requires the pyarrow package)
+PARQUET_EXPORT = False
+PARQUET_COMPRESSION = 'snappy'
+
 
 def log_ascii():
     """Log the KHP ascii art
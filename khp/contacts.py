@@ -4,16 +4,15 @@ import os
 
 from dask import delayed, compute
 import pandas as pd
-import postgrez
 
 from khp import utils
 from khp import config
+from khp import db
 from khp.icescape import Icescape
 from khp.transforms import Transformer
 
 LOGGER = logging.getLogger(__name__)
 CONF = config.CONFIG
-DB_CONF = CONF['database']
 
 def save_data(data, filename):
     """Save data from icescape API.
@@ -56,30 +55,74 @@ def download_contacts(interaction_type, start_date=None, end_date=None):
                                                start_dt.strftime("%Y-%m-%d"))
         save_data(contact_data, filename)
 
+# next page of the contact ids returned by a query, by key
+CONTACT_ID_PAGE = """
+    SELECT contact_id FROM ({query}) AS contact_ids
+    WHERE %s IS NULL OR contact_id > %s
+    ORDER BY contact_id LIMIT %s
+    """
+
+def _contact_id_batches(query, batch_size=config.DB_STREAM_BATCH_SIZE):
+    """Page through the contact ids returned by a query, in order. Each page
+    is fetched by key in its own short transaction, so no transaction is
+    held open while a batch is processed. The query is run once per page,
+    so it should be able to use an index on ``contact_id``.
+
+    Args:
+        query (str): Query selecting a ``contact_id`` column
+        batch_size (:obj:`int`, optional): Number of contact ids per batch.
+            Defaults to `config.DB_STREAM_BATCH_SIZE`.
+
+    Yields:
+        list: Batch of contact ids
+    """
+    page = CONTACT_ID_PAGE.format(query=query)
+    last = None
+    while True:
+        rows = db.execute(page, (last, last, batch_size))
+        if not rows:
+            return
+        batch = [record['contact_id'] for record in rows]
+        yield batch
+        last = batch[-1]
+
 def download_transcripts(contact_ids=None):
     """Download transcripts for a list of contact_ids.
 
     Args:
         contact_ids (:obj:`list`, optional): List of Contact IDs to retrieve
-            recordings for. If None are provided (default), queries contacts
-            that have not been parsed
+            recordings for. If None are provided (default), pages through the
+            contacts that have not been parsed, a batch at a time
     """
     if contact_ids is None:
         query = """
             SELECT contact_id FROM contacts WHERE transcript_downloaded=FALSE
             AND agent_id IS NOT NULL
             """
-        data = postgrez.execute(query=query, host=DB_CONF['host'],
-                                user=DB_CONF['user'], password=DB_CONF['pwd'],
-                                database=DB_CONF['db'])
-        contact_ids = [record['contact_id'] for record in data]
-
-    if not contact_ids:
+        batches = _contact_id_batches(query)
+    else:
+        batches = iter([contact_ids])
+
+    ice = None
+    processed = 0
+    for batch in batches:
+        if not batch:
+            continue
+        LOGGER.info("Attempting to process %s contact ids", len(batch))
+        ice = ice or Icescape()
+        _download_transcripts(ice, batch)
+        processed += len(batch)
+    if not processed:
         LOGGER.warning("No contact ids to parse. Exiting..")
-        return
 
-    LOGGER.info("Attempting to process %s contact ids", len(contact_ids))
-    ice = Icescape()
+def _download_transcripts(ice, contact_ids):
+    """Download and save the transcripts of a batch of contact ids, marking
+    them as downloaded.
+
+    Args:
+        ice (khp.icescape.Icescape): Icescape API session
+        contact_ids (list): List of Contact IDs
+    """
     for chunked_contact_ids in utils.chunker(contact_ids, 20):
         transcripts = ice.get_recordings(chunked_contact_ids)
         if len(transcripts) < len(chunked_contact_ids):
@@ -96,9 +139,7 @@ def download_transcripts(contact_ids=None):
             UPDATE contacts SET transcript_downloaded=TRUE
             WHERE contact_id IN ({})
             """.format(','.join([str(id) for id in chunked_contact_ids]))
-        postgrez.execute(query=update_query, host=DB_CONF['host'],
-                         user=DB_CONF['user'], password=DB_CONF['pwd'],
-                         database=DB_CONF['db'])
+        db.execute(update_query)
 
 def parse_contacts_file(filename):
     """Parse the JSON contacts file downloaded from Icescape. Parsing includes:
@@ -132,9 +173,7 @@ def parse_contacts_file(filename):
     columns = list(parsed_contacts[0].keys())
     load_data = [[contact_data[key] for key in columns]
                  for contact_data in parsed_contacts]
-    postgrez.load(table_name="contacts", data=load_data, columns=columns,
-                  host=DB_CONF['host'], user=DB_CONF['user'],
-                  password=DB_CONF['pwd'], database=DB_CONF['db'])
+    db.load(table_name="contacts", data=load_data, columns=columns)
 
 def parse_transcript(filename):
     """Parse the transcript file downloaded from Icescape. Parsing includes:
@@ -158,15 +197,7 @@ def parse_transcript(filename):
     load_data = [[message[key] for key in columns]
                  for message in messages]
 
-    # Remove any | from the message strings, as the postgrez load from object method
-    for i, row in enumerate(load_data):
-        for j, record in enumerate(row):
-            if isinstance(record, str):
-                load_data[i][j] = load_data[i][j].replace('|', '')
-
-    postgrez.load(table_name="transcripts", data=load_data, columns=columns,
-                  host=DB_CONF['host'], user=DB_CONF['user'],
-                  password=DB_CONF['pwd'], database=DB_CONF['db'])
+    db.load(table_name="transcripts", data=load_data, columns=columns)
 
 
 def get_contacts_to_load():
@@ -178,8 +209,7 @@ def get_contacts_to_load():
     """
     contacts_reg = r"^\w*_\d{4}-\d{1,2}-\d{1,2}_\w*"
     query = "SELECT load_file FROM contacts GROUP BY 1"
-    data = postgrez.execute(query, host=DB_CONF['host'], user=DB_CONF['user'],
-                            password=DB_CONF['pwd'], database=DB_CONF['db'])
+    data = db.execute(query)
     loaded_files = [record['load_file'] for record in data]
     files = utils.search_path(config.ICESCAPE_OUTPUT_DIR, [contacts_reg])
     filenames = [os.path.basename(file) for file in files]
@@ -194,41 +224,47 @@ def get_transcripts_to_load():
         list: List of trancsript files to load
     """
     transcripts_reg = r"^\d*_data.txt"
-    query = "SELECT contact_id FROM transcripts GROUP BY 1"
-    data = postgrez.execute(query, host=DB_CONF['host'], user=DB_CONF['user'],
-                            password=DB_CONF['pwd'], database=DB_CONF['db'])
-    loaded_contacts = [record['contact_id'] for record in data]
     files = utils.search_path(config.ICESCAPE_OUTPUT_DIR, [transcripts_reg])
-    filenames = [os.path.basename(file) for file in files]
+    filenames = {int(os.path.basename(file).split('_data.txt')[0]):
+                 os.path.basename(file) for file in files}
 
-    to_load = []
-    for file in filenames:
-        basename = os.path.basename(file)
-        contact_id = int(basename.split('_data.txt')[0])
-        if contact_id not in loaded_contacts:
-            to_load.append(basename)
+    # only look up the contacts with files, rather than every loaded contact
+    query = """
+        SELECT DISTINCT contact_id FROM transcripts
+        WHERE contact_id = ANY(%s)
+        """
+    loaded_contacts = set()
+    for rows in db.stream(query, (list(filenames),)):
+        loaded_contacts.update(record['contact_id'] for record in rows)
+
+    to_load = [filename for contact_id, filename in filenames.items()
+               if contact_id not in loaded_contacts]
     LOGGER.info("%s transcripts to parse and load", len(to_load))
     return to_load
 
-def load_transcripts_df(contact_ids):
+def load_transcripts_df(contact_ids, chunksize=None):
     """Load the transcripts data associated with a set of contact_ids into
     a pandas Dataframe.
 
     Args:
         contact_ids (list): List of contact ids to load
+        chunksize (:obj:`int`, optional): Stream the transcripts through a
+            server-side cursor instead, as Dataframes of this many rows.
+            Defaults to None, loading them all at once.
 
     Returns:
-        pandas.Dataframe: Dataframe containing the loaded transcripts
+        pandas.Dataframe: Dataframe containing the loaded transcripts, or an
+        iterator of Dataframes if `chunksize` is given
     """
     LOGGER.info("Loading transcripts for contact_ids: %s", contact_ids)
     query = """
-        SELECT * FROM transcripts WHERE contact_id IN ({})
+        SELECT * FROM transcripts WHERE contact_id = ANY(%s)
         ORDER BY contact_id, dt ASC
-        """.format(','.join([str(id) for id in contact_ids]))
-    data = postgrez.execute(query, host=DB_CONF['host'], user=DB_CONF['user'],
-                            password=DB_CONF['pwd'], database=DB_CONF['db'])
-    dataframe = pd.DataFrame(data)
-    return dataframe
+        """
+    params = ([int(contact_id) for contact_id in contact_ids],)
+    if chunksize is not None:
+        return db.stream_frames(query, params, batch_size=chunksize)
+    return db.read_frame(query, params)
 
 def load_enhanced_transcript(contact_id, summary):
     """Load the transcript summary dictionary to the enhanced_transcripts table
@@ -242,9 +278,7 @@ def load_enhanced_transcript(contact_id, summary):
     load_data = [[contact_id] + [summary[key] for key in columns]]
     columns = ['contact_id'] + columns
 
-    postgrez.load(table_name="enhanced_transcripts", data=load_data,
-                  columns=columns, host=DB_CONF['host'], user=DB_CONF['user'],
-                  password=DB_CONF['pwd'], database=DB_CONF['db'])
+    db.load(table_name="enhanced_transcripts", data=load_data, columns=columns)
 
 def replace_nans(summary):
     """Replace any np.nan's in the summary dict prior to loading to Postgres
@@ -263,33 +297,38 @@ def replace_nans(summary):
 def enhanced_transcripts():
     """Read in un-processed transcripts from Postgres, perform a series of
     operations to produce metadata per contact_id, load into table
-    enhanced_transcripts
+    enhanced_transcripts. The contact ids to process are streamed through a
+    server-side cursor in a single pass, then processed a batch at a time
+    once the cursor is closed.
     """
     query = """
         SELECT contact_id FROM transcripts WHERE contact_id NOT IN
         (SELECT contact_id FROM enhanced_transcripts)
         GROUP BY 1
         """
-    data = postgrez.execute(query, host=DB_CONF['host'], user=DB_CONF['user'],
-                            password=DB_CONF['pwd'], database=DB_CONF['db'])
-    to_load = [record['contact_id'] for record in data]
 
     transcripts_tforms = config.TRANSFORMS["transcripts"]
     transcripts_meta_tforms = config.TRANSFORMS['transcript_summary']
     optimus = Transformer(transcripts_tforms)
     megatron = Transformer(transcripts_meta_tforms)
 
-    delayeds = []
-    for contact_id in to_load:
-        LOGGER.info('Processing transcript for contact_id %s', contact_id)
-        dataframe = delayed(load_transcripts_df)([contact_id])
-        dataframe = delayed(optimus.run_df_transforms)(dataframe)
-        summary = delayed(megatron.run_meta_df_transforms)(dataframe)
-        summary = delayed(replace_nans)(summary)
-        out = delayed(load_enhanced_transcript)(contact_id, summary)
-        delayeds.append(out)
-
-    compute(*delayeds, scheduler='threads', num_workers=20)
+    # the ids are small, and finding them scans all of transcripts, so they
+    # are read once rather than paged through
+    contact_ids = [record['contact_id'] for rows in db.stream(query)
+                   for record in rows]
+    for to_load in utils.chunker(contact_ids, config.DB_STREAM_BATCH_SIZE):
+        delayeds = []
+        for contact_id in to_load:
+            LOGGER.info('Processing transcript for contact_id %s', contact_id)
+            dataframe = delayed(load_transcripts_df)([contact_id])
+            dataframe = delayed(optimus.run_df_transforms)(dataframe)
+            summary = delayed(megatron.run_meta_df_transforms)(dataframe)
+            summary = delayed(replace_nans)(summary)
+            out = delayed(load_enhanced_transcript)(contact_id, summary)
+            delayeds.append(out)
+
+        compute(*delayeds, scheduler='threads', num_workers=20)
+    LOGGER.info("Database pool: %s", db.pool().stats())
 
 def main(interaction_type='IM', start_date=None, end_date=None):
     """Run the full contacts pipeline.
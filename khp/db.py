@@ -0,0 +1,537 @@
+"""
+Access to the KHP database over a process-wide pool of psycopg2 connections,
+shared by every thread, so queries reuse connections instead of opening one
+each. `execute` and `load` run a single query or insert; `connection` checks
+out a connection for bulk loads that need COPY and explicit transactions.
+Large result sets are streamed in batches through server-side cursors with
+`stream` and `stream_frames`, so memory use does not grow with the table.
+
+Example:
+
+>>> from khp import db
+>>> db.execute("SELECT contact_id FROM contacts LIMIT 1")
+[{'contact_id': 1234}]
+>>> db.pool().stats()['checkouts']
+1
+
+Bulk loads COPY a batch of rows into an unlogged staging table shaped like
+the target, then merge them with ``INSERT ... ON CONFLICT DO NOTHING``, so
+rows that are already loaded (e.g. from a re-published report) are skipped
+instead of aborting the load. Together with recording the batch's reports in
+``loaded_reports`` in the same transaction, this makes reloading a batch
+idempotent. Tables without a unique constraint (e.g. the stat tables) are
+copied into directly, relying on ``loaded_reports`` alone.
+
+Large backfills can defer index maintenance with `deferred_indexes`.
+"""
+
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime
+import logging
+import itertools
+import os
+import threading
+import time
+
+import pandas as pd
+import psycopg2
+from psycopg2 import extensions, sql
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import PoolError
+
+from khp import config
+from khp import reports
+
+LOGGER = logging.getLogger(__name__)
+DB_CONF = config.CONFIG['database']
+
+STAGING_SUFFIX = '_staging'
+
+# definitions of the indexes dropped by deferred_indexes until they are rebuilt
+DEFERRED_INDEXES = """
+    CREATE TABLE IF NOT EXISTS deferred_indexes (
+        index_name VARCHAR(200) PRIMARY KEY,
+        table_name VARCHAR(200),
+        definition TEXT
+    )
+"""
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+# numbers the server-side cursors, whose names must be unique per connection
+_CURSOR_IDS = itertools.count()
+
+def connect():
+    """Open a new connection to the KHP database.
+
+    Returns:
+        psycopg2.extensions.connection: Database connection
+    """
+    return psycopg2.connect(host=DB_CONF['host'], user=DB_CONF['user'],
+                            password=DB_CONF['pwd'], dbname=DB_CONF['db'])
+
+class ConnectionPool():
+    """A bounded, thread-safe pool of database connections. `min_size`
+    connections are opened up front and kept open. The pool grows on demand
+    up to `max_size`, and connections beyond `min_size` are closed once idle
+    for `max_idle` seconds. Checkouts block while `max_size` connections are
+    in use.
+
+    Connections are returned to the pool in a clean state: open transactions
+    are rolled back, and broken connections are discarded.
+
+    Attributes:
+        min_size (int): Number of connections kept open
+        max_size (int): Maximum number of connections open at once
+        max_idle (int): Seconds before an idle connection beyond `min_size`
+            is closed
+        timeout (int): Seconds to wait for a free connection before raising
+            `psycopg2.pool.PoolError`, None to wait forever
+    """
+
+    def __init__(self, min_size=config.DB_POOL_MIN_SIZE,
+                 max_size=config.DB_POOL_MAX_SIZE,
+                 max_idle=config.DB_POOL_MAX_IDLE,
+                 timeout=config.DB_POOL_TIMEOUT):
+        if max_size < 1 or not 0 <= min_size <= max_size:
+            raise ValueError("Pool sizes must satisfy "
+                             "0 <= min_size <= max_size, max_size >= 1")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.pid = os.getpid()
+        # idle connections and the time they were returned, most recent last
+        self._idle = deque()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._open = 0
+        self._in_use = 0
+        self._counts = Counter()
+        self._checkout_time = 0.0
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.time()))
+
+    def _connect(self):
+        conn = connect()
+        with self._lock:
+            self._open += 1
+            self._counts['connects'] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._open -= 1
+            self._counts['discards'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _reset(self, conn):
+        """Roll back any open transaction, returning whether the connection
+        can be reused."""
+        if conn.closed:
+            return False
+        # connection.info needs psycopg2 2.8
+        status = conn.get_transaction_status()
+        if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _expire_idle(self):
+        """Close idle connections beyond `min_size` that have been idle for
+        more than `max_idle` seconds."""
+        expired = []
+        with self._lock:
+            while (len(self._idle) > self.min_size
+                   and time.time() - self._idle[0][1] > self.max_idle):
+                expired.append(self._idle.popleft()[0])
+        for conn in expired:
+            self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection from the pool, blocking until one is free.
+
+        Yields:
+            psycopg2.extensions.connection: Database connection
+        """
+        start = time.time()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._counts['waits'] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                raise PoolError("No connection free after {}s".format(
+                    self.timeout))
+        try:
+            with self._lock:
+                conn = self._idle.pop()[0] if self._idle else None
+            if conn is None:
+                conn = self._connect()
+            with self._lock:
+                self._checkout_time += time.time() - start
+                self._in_use += 1
+                self._counts['checkouts'] += 1
+                self._counts['max_in_use'] = max(self._counts['max_in_use'],
+                                                 self._in_use)
+            try:
+                yield conn
+            finally:
+                with self._lock:
+                    self._in_use -= 1
+                try:
+                    reusable = self._reset(conn)
+                except Exception:
+                    reusable = False
+                if reusable:
+                    with self._lock:
+                        self._idle.append((conn, time.time()))
+                else:
+                    self._discard(conn)
+                self._expire_idle()
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        """Get the metrics of the pool.
+
+        Returns:
+            dict: Connections ``open``, ``idle`` and ``in_use``, along with
+            counts of ``checkouts``, ``waits`` (checkouts that found every
+            connection in use), ``connects`` and ``discards`` (connections
+            opened and closed), the ``max_in_use`` at once, and the total and
+            mean seconds spent checking out connections (``checkout_time``
+            and ``mean_checkout_time``), including waits and connects
+        """
+        with self._lock:
+            stats = dict(self._counts)
+            stats.update(open=self._open, idle=len(self._idle),
+                         in_use=self._in_use,
+                         checkout_time=self._checkout_time)
+        for key in ('checkouts', 'waits', 'connects', 'discards',
+                    'max_in_use'):
+            stats.setdefault(key, 0)
+        stats['mean_checkout_time'] = (
+            stats['checkout_time'] / stats['checkouts']
+            if stats['checkouts'] else 0.0)
+        return stats
+
+    def close(self):
+        """Close all idle connections in the pool."""
+        with self._lock:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+        for conn in idle:
+            self._discard(conn)
+
+def pool():
+    """Get the process-wide connection pool, created on first use with the
+    sizes in the config. A forked process gets a pool of its own.
+
+    Returns:
+        ConnectionPool: Shared connection pool
+    """
+    global _POOL
+    if _POOL is None or _POOL.pid != os.getpid():
+        with _POOL_LOCK:
+            if _POOL is None or _POOL.pid != os.getpid():
+                _POOL = ConnectionPool()
+    return _POOL
+
+@contextmanager
+def connection():
+    """Check out a connection from the shared pool, returned to it on exit.
+    Use the connection itself as a context manager to run a transaction; any
+    transaction left open is rolled back when it is returned.
+
+    Yields:
+        psycopg2.extensions.connection: Database connection
+    """
+    with pool().connection() as conn:
+        yield conn
+
+def execute(query, params=None):
+    """Run a query in its own transaction, over a pooled connection.
+
+    Args:
+        query (str): SQL query
+        params (:obj:`tuple` or :obj:`dict`, optional): Query parameters.
+            Defaults to None.
+
+    Returns:
+        list: Rows returned by the query, as dicts keyed by column name. None
+        if the query returns no rows (e.g. an UPDATE).
+    """
+    with connection() as conn, conn, \
+            conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute(query, params)
+        if cursor.description is None:
+            return None
+        return cursor.fetchall()
+
+def read_frame(query, params=None):
+    """Run a query, returning its rows as a DataFrame. Rows are fetched as
+    tuples, rather than one dict per row.
+
+    Args:
+        query (str): SQL query
+        params (:obj:`tuple` or :obj:`dict`, optional): Query parameters.
+            Defaults to None.
+
+    Returns:
+        pandas.DataFrame: Rows of the query, with a column per column of the
+        result
+    """
+    with connection() as conn, conn, conn.cursor() as cursor:
+        cursor.execute(query, params)
+        return pd.DataFrame.from_records(
+            cursor.fetchall(),
+            columns=[column.name for column in cursor.description])
+
+def _stream(query, params, batch_size, cursor_factory=None):
+    """Run a query through a named (server-side) cursor, yielding its column
+    names and batches of rows."""
+    name = 'khp_stream_{}'.format(next(_CURSOR_IDS))
+    # named cursors only live within a transaction
+    with connection() as conn, conn, conn.cursor(
+            name=name, cursor_factory=cursor_factory) as cursor:
+        cursor.itersize = batch_size
+        cursor.execute(query, params)
+        streamed = 0
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            streamed += len(rows)
+            yield [column.name for column in cursor.description], rows
+        LOGGER.debug("Streamed %s rows through cursor %s", streamed, name)
+
+def stream(query, params=None, batch_size=config.DB_STREAM_BATCH_SIZE):
+    """Run a query through a server-side cursor, yielding its rows in
+    batches, so only one batch is held in memory at a time. The query runs in
+    a transaction on a pooled connection, which is held until the generator
+    is exhausted or closed; wrap it in `contextlib.closing` if it may not be
+    consumed fully.
+
+    Args:
+        query (str): SQL query
+        params (:obj:`tuple` or :obj:`dict`, optional): Query parameters.
+            Defaults to None.
+        batch_size (:obj:`int`, optional): Number of rows fetched at once.
+            Defaults to `config.DB_STREAM_BATCH_SIZE`.
+
+    Yields:
+        list: Batch of rows, as dicts keyed by column name
+    """
+    for _, rows in _stream(query, params, batch_size, RealDictCursor):
+        yield rows
+
+def stream_frames(query, params=None, batch_size=config.DB_STREAM_BATCH_SIZE):
+    """Run a query through a server-side cursor, yielding its rows as
+    DataFrame chunks. See `stream`.
+
+    Args:
+        query (str): SQL query
+        params (:obj:`tuple` or :obj:`dict`, optional): Query parameters.
+            Defaults to None.
+        batch_size (:obj:`int`, optional): Number of rows per chunk.
+            Defaults to `config.DB_STREAM_BATCH_SIZE`.
+
+    Yields:
+        pandas.DataFrame: Chunk of rows
+    """
+    for columns, rows in _stream(query, params, batch_size):
+        yield pd.DataFrame.from_records(rows, columns=columns)
+
+def load(table_name, data, columns, page_size=1000):
+    """Insert rows into a table in one transaction, over a pooled connection.
+
+    Args:
+        table_name (str): Name of the table
+        data (list): List of lists of values, in the order of `columns`
+        columns (list): Names of the columns
+        page_size (:obj:`int`, optional): Number of rows per INSERT
+            statement. Defaults to 1000.
+    """
+    query = sql.SQL("INSERT INTO {} ({}) VALUES %s").format(
+        sql.Identifier(table_name),
+        sql.SQL(', ').join(sql.Identifier(column) for column in columns))
+    with connection() as conn, conn, conn.cursor() as cursor:
+        execute_values(cursor, query.as_string(conn), data,
+                       page_size=page_size)
+    LOGGER.debug("Loaded %s rows into %s", len(data), table_name)
+
+def copy_frame(cursor, df, table):
+    """COPY the rows of a DataFrame into a table.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): Database cursor
+        df (pandas.DataFrame): Rows to copy, with columns named after the
+            table's
+        table (str): Name of the table
+
+    Returns:
+        int: Number of rows copied
+    """
+    query = sql.SQL("COPY {} ({}) FROM STDIN").format(
+        sql.Identifier(table),
+        sql.SQL(', ').join(sql.Identifier(column) for column in df.columns))
+    cursor.copy_expert(query.as_string(cursor), reports.to_copy_buffer(df))
+    return cursor.rowcount
+
+def merge_frame(cursor, df, table):
+    """Bulk load the rows of a DataFrame into a table, skipping rows that
+    conflict with ones already loaded. The rows are copied into an unlogged
+    staging table, ``<table>_staging``, created on first use, then inserted
+    with ``ON CONFLICT DO NOTHING``.
+
+    The staging table is truncated within the caller's transaction, which
+    locks it, so concurrent loads into the same table run one at a time.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): Database cursor
+        df (pandas.DataFrame): Rows to load, with columns named after the
+            table's
+        table (str): Name of the table
+
+    Returns:
+        int: Number of rows inserted
+    """
+    staging = sql.Identifier(table + STAGING_SUFFIX)
+    columns = sql.SQL(', ').join(sql.Identifier(column)
+                                 for column in df.columns)
+    cursor.execute(sql.SQL(
+        "CREATE UNLOGGED TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS)"
+    ).format(staging, sql.Identifier(table)))
+    cursor.execute(sql.SQL("TRUNCATE {}").format(staging))
+    copy_frame(cursor, df, table + STAGING_SUFFIX)
+    cursor.execute(sql.SQL(
+        "INSERT INTO {0} ({1}) SELECT {1} FROM {2} ON CONFLICT DO NOTHING"
+    ).format(sql.Identifier(table), columns, staging))
+    inserted = cursor.rowcount
+    cursor.execute(sql.SQL("TRUNCATE {}").format(staging))
+    LOGGER.debug("Merged %s rows into %s, %s new", len(df), table, inserted)
+    return inserted
+
+def _rebuild_indexes(cursor, table, indexes):
+    """Recreate the deferred indexes of a table that are missing, forget
+    them, and analyze the table.
+    """
+    start = datetime.now()
+    for name, definition in indexes:
+        cursor.execute("SELECT to_regclass(quote_ident(%s)) IS NULL", (name,))
+        if cursor.fetchone()[0]:
+            cursor.execute(definition)
+    cursor.execute("DELETE FROM deferred_indexes WHERE table_name = %s",
+                   (table,))
+    cursor.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+    LOGGER.info("Rebuilt %s indexes on %s in %s", len(indexes), table,
+                datetime.now() - start)
+
+def restore_indexes(conn, table):
+    """Rebuild the indexes of a table left dropped by a `deferred_indexes`
+    load that died before rebuilding them.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection, outside
+            of a transaction
+        table (str): Name of the table
+
+    Returns:
+        int: Number of indexes rebuilt
+    """
+    with conn, conn.cursor() as cursor:
+        cursor.execute(DEFERRED_INDEXES)
+        cursor.execute("SELECT index_name, definition FROM deferred_indexes "
+                       "WHERE table_name = %s", (table,))
+        indexes = cursor.fetchall()
+        if indexes:
+            LOGGER.warning("Restoring %s indexes on %s left dropped by an "
+                           "earlier load", len(indexes), table)
+            _rebuild_indexes(cursor, table, indexes)
+    return len(indexes)
+
+@contextmanager
+def deferred_indexes(conn, table):
+    """Drop the secondary indexes of a table, and rebuild them on exit, so a
+    large load does not update them row by row. Unique indexes, which
+    ``ON CONFLICT`` relies on, are kept. The table is analyzed once the
+    indexes are rebuilt.
+
+    The indexes are missing while the load runs, so queries on the table are
+    slower until it finishes. Their definitions are saved in the
+    ``deferred_indexes`` table in the transaction that drops them, so if the
+    process dies before rebuilding them, the next load of the table does
+    (see `restore_indexes`).
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection, outside
+            of a transaction
+        table (str): Name of the table
+
+    Yields:
+        list: Names of the deferred indexes
+    """
+    with conn, conn.cursor() as cursor:
+        cursor.execute(DEFERRED_INDEXES)
+        cursor.execute(
+            "SELECT c.relname, pg_get_indexdef(i.indexrelid) "
+            "FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE i.indrelid = %s::regclass AND NOT i.indisunique",
+            (table,))
+        for name, definition in cursor.fetchall():
+            LOGGER.info("Dropping index %s: %s", name, definition)
+            cursor.execute(
+                "INSERT INTO deferred_indexes "
+                "(index_name, table_name, definition) VALUES (%s, %s, %s) "
+                "ON CONFLICT (index_name) DO UPDATE SET "
+                "table_name = EXCLUDED.table_name, "
+                "definition = EXCLUDED.definition",
+                (name, table, definition))
+            cursor.execute(sql.SQL("DROP INDEX {}").format(
+                sql.Identifier(name)))
+        # includes any left dropped by an earlier load
+        cursor.execute("SELECT index_name, definition FROM deferred_indexes "
+                       "WHERE table_name = %s", (table,))
+        indexes = cursor.fetchall()
+    try:
+        yield [name for name, _ in indexes]
+    finally:
+        with conn, conn.cursor() as cursor:
+            _rebuild_indexes(cursor, table, indexes)
+
+def loaded_reports(cursor, report_type):
+    """Get the reports of a type that have already been loaded.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): Database cursor
+        report_type (str): Type of the reports, e.g. FTCI
+
+    Returns:
+        set: Names of the loaded reports
+    """
+    cursor.execute("SELECT report_name FROM loaded_reports "
+                   "WHERE report_type = %s", (report_type,))
+    return {row[0] for row in cursor.fetchall()}
+
+def record_loaded_reports(cursor, report_names, report_type):
+    """Record reports as loaded, ignoring ones that already are.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): Database cursor
+        report_names (list): Names of the reports
+        report_type (str): Type of the reports, e.g. FTCI
+    """
+    load_dt = datetime.now()
+    execute_values(
+        cursor,
+        "INSERT INTO loaded_reports (load_dt, report_name, report_type) "
+        "VALUES %s ON CONFLICT DO NOTHING",
+        [(load_dt, report_name, report_type) for report_name in report_names])
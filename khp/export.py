@@ -0,0 +1,76 @@
+"""
+Export of loaded reports as Parquet, so heavy analytical scans can run in a
+columnar engine instead of against Postgres. Rows are written with proper
+integer and timestamp types, one file per day and load, under hive style
+``<table>/date=YYYY-MM-DD/`` partitions, locally and optionally to S3.
+
+Requires the pyarrow package.
+
+Example:
+
+>>> from khp import export, reports
+>>> df = reports.parse(b'1001|1|2|2018-10-01 12:00:00\\r\\n', 'ftci')
+>>> export.write_parquet(df, 'ftci', 'part-20181002120000')
+"""
+
+import logging
+import os
+import posixpath
+
+from khp import config
+from khp import reports
+from khp import utils
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = None
+    pq = None
+
+LOGGER = logging.getLogger(__name__)
+
+# S3 prefix the parquet datasets are uploaded under
+S3_PREFIX = 'parquet/'
+
+def write_parquet(df, table, batch, output_dir=config.PARQUET_OUTPUT_DIR,
+                  s3_bucket=None, compression=config.PARQUET_COMPRESSION):
+    """Write a DataFrame as Parquet, with one file per day of its date column
+    (see `khp.reports.date_column`) at
+    ``<output_dir>/<table>/date=YYYY-MM-DD/<batch>.parquet``.
+
+    Args:
+        df (pandas.DataFrame): Typed rows, see `khp.reports.parse`
+        table (str): Name of the table, one of `khp.reports.TABLES`
+        batch (str): Name of the files, unique to this load
+        output_dir (:obj:`str`, optional): Root of the local datasets.
+            Defaults to `config.PARQUET_OUTPUT_DIR`.
+        s3_bucket (:obj:`str`, optional): Also upload the files to this
+            bucket, under `S3_PREFIX`. Defaults to None.
+        compression (:obj:`str`, optional): Parquet compression codec.
+            Defaults to `config.PARQUET_COMPRESSION`.
+
+    Returns:
+        list: Paths of the files written
+    """
+    if pq is None:
+        raise ImportError("Parquet export requires the pyarrow package")
+    paths = []
+    dates = df[reports.date_column(table)].dt.date
+    for day, frame in df.groupby(dates):
+        relpath = posixpath.join(table, 'date={}'.format(day),
+                                 batch + '.parquet')
+        path = os.path.join(output_dir, *relpath.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # millisecond timestamps can be read by older engines
+        pq.write_table(pyarrow.Table.from_pandas(frame, preserve_index=False),
+                       path, compression=compression, coerce_timestamps='ms',
+                       allow_truncated_timestamps=True)
+        if s3_bucket is not None:
+            utils.s3_client().upload_file(
+                path, s3_bucket, S3_PREFIX + relpath,
+                ExtraArgs={'ServerSideEncryption': 'AES256'})
+        paths.append(path)
+    LOGGER.info("Exported %s %s rows to %s parquet files", len(df), table,
+                len(paths))
+    return paths
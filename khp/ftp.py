@@ -1,119 +1,1063 @@
-from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, closing, contextmanager
+from datetime import date, datetime, timedelta
 import os
+import hashlib
+import json
 import logging
+import posixpath
+import queue
+import threading
+import time
 
-import postgrez
+import pandas as pd
+from khp import compaction
 from khp import config
+from khp import db
+from khp import export
 from khp import utils
-from khp.implicity_tls import tyFTP
+from khp import ftplib_mod as ftplib
+from khp import reports
+from khp import summary
+from khp.implicitly_tls import tyFTP, create_context
+from khp.manifest import KeyManifest, Manifest
 
 LOG = logging.getLogger(__name__)
 CONF = config.CONFIG
 S3_BUCKET = CONF['aws']['s3_bucket']
+# file name prefixes of the reports loaded into each stat table
+STAT_PREFIXES = {
+    'stat_adr': config.STAT_ADR_PREFIX,
+    'stat_cdr': config.STAT_CDR_PREFIX,
+}
+# shared by all sessions so TLS sessions can be cached and resumed
+SSL_CONTEXT = create_context()
 
-def download(folder, output_dir):
-    """Download files from a folder within the KHP FTP server.
+def connect():
+    """Open an authenticated session with the KHP FTP server, with a secure
+    (PROT P) data connection.
+
+    Returns:
+        khp.implicitly_tls.tyFTP: Logged in FTP session
+    """
+    ftp_conf = CONF['ftp']
+    ftp = tyFTP(context=SSL_CONTEXT)
+    LOG.debug("Connecting to host %s", ftp_conf['host'])
+    ftp.connect(host=ftp_conf['host'].encode("ascii"),
+                port=ftp_conf['port'])
+    LOG.debug("Logging into host %s", ftp_conf['host'])
+    ftp.login(user=ftp_conf['user'], passwd=ftp_conf['pwd'])
+    LOG.debug("Switching to secure data connection")
+    ftp.prot_p()
+    return ftp
+
+class FTPPool():
+    """A bounded pool of authenticated FTP sessions. Sessions are opened
+    lazily, up to `size` of them, and each one is handed out to a single
+    thread at a time.
+
+    Attributes:
+        size (int): Maximum number of sessions open at once
+        folder (str): Folder each new session is switched into
+        sessions (list): Every session opened by the pool
+    """
+
+    def __init__(self, size, folder=None):
+        if size < 1:
+            raise ValueError("FTP pool size must be at least 1")
+        self.size = size
+        self.folder = folder
+        self.sessions = []
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _open(self):
+        ftp = connect()
+        self.sessions.append(ftp)
+        if self.folder:
+            ftp.cwd(self.folder)
+        return ftp
+
+    @property
+    def handshakes(self):
+        """collections.Counter: `full` and `resumed` TLS handshakes summed
+        over every session opened by the pool."""
+        return sum((ftp.handshakes for ftp in self.sessions), Counter())
+
+    @staticmethod
+    def _discard(ftp):
+        try:
+            ftp.close()
+        except ftplib.all_errors:
+            pass
+
+    @contextmanager
+    def session(self):
+        """Check out a session from the pool, blocking until one is free.
+        Sessions that raise an FTP error are closed rather than returned to
+        the pool.
+
+        Yields:
+            khp.implicitly_tls.tyFTP: Logged in FTP session
+        """
+        self._slots.acquire()
+        try:
+            try:
+                ftp = self._idle.get_nowait()
+            except queue.Empty:
+                ftp = self._open()
+            try:
+                yield ftp
+            except ftplib.all_errors:
+                self._discard(ftp)
+                raise
+            except Exception:
+                self._idle.put(ftp)
+                raise
+            else:
+                self._idle.put(ftp)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Quit all idle sessions in the pool."""
+        while True:
+            try:
+                ftp = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                self._discard(ftp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, exc_tb):
+        self.close()
+
+def _throughput(nbytes, seconds):
+    """Format a transfer rate in MB/s."""
+    return "{:.2f} MB/s".format(nbytes / 1e6 / max(seconds, 1e-6))
+
+def parse_list_line(line):
+    """Parse a line of `LIST` output, in either unix or DOS format, into a
+    filename and a dictionary of facts.
+    """
+    words = line.split(None, 8)
+    if len(words) == 9:
+        # -rw-r--r--   1 owner    group     312 Aug  1  1994 welcome.msg
+        facts = {
+            'type': 'dir' if words[0].startswith('d') else 'file',
+            'size': words[4],
+            'modify': ' '.join(words[5:8])
+        }
+        return words[8].lstrip(), facts
+    # 08-01-94  12:00PM                  312 welcome.msg
+    words = line.split(None, 3)
+    facts = {
+        'type': 'dir' if words[2] == '<DIR>' else 'file',
+        'size': None if words[2] == '<DIR>' else words[2],
+        'modify': ' '.join(words[:2])
+    }
+    return words[-1].lstrip(), facts
+
+def list_entries(ftp):
+    """List the files in the current folder of an FTP session, along with
+    their size and modification time. `MLSD` is used when the server supports
+    it, falling back to parsing the `LIST` output.
+
+    Args:
+        ftp (khp.implicitly_tls.tyFTP): Logged in FTP session
+
+    Returns:
+        dict: Facts for each file, keyed by filename, e.g.
+            ``{'V2_ftci.txt': {'size': '312', 'modify': '20180801120000'}}``
+    """
+    try:
+        listing = list(ftp.mlsd(facts=['type', 'size', 'modify']))
+    except ftplib.error_perm:
+        LOG.debug("MLSD not supported, falling back to LIST")
+        lines = []
+        ftp.retrlines("LIST", lines.append)
+        listing = [parse_list_line(line) for line in lines]
+    return {name: {'size': facts.get('size'), 'modify': facts.get('modify')}
+            for name, facts in listing if facts.get('type', 'file') == 'file'}
+
+def list_files(ftp):
+    """List the files in the current folder of an FTP session.
+
+    Args:
+        ftp (khp.implicitly_tls.tyFTP): Logged in FTP session
+
+    Returns:
+        list: Filenames in the current folder
+    """
+    return sorted(list_entries(ftp))
+
+def _partial_path(output_dir, filename):
+    """Path an in-progress download is written to. Partial files are hidden
+    so they are never picked up by `load_to_s3` or removed by
+    `utils.clean_dir`.
+    """
+    return os.path.join(output_dir, '.{}.part'.format(filename))
+
+def _partial_source(partial_file):
+    """Path of the file recording the size and modification time of the
+    remote file a partial download was taken from.
+    """
+    return partial_file + '.json'
+
+def _resumable(partial_file, source):
+    """Check whether a partial download was taken from the same version of
+    the remote file, as described by `source`.
+
+    Args:
+        partial_file (str): Path of the partial download
+        source (dict): Listed ``size`` and ``modify`` facts of the remote file
+
+    Returns:
+        bool: Whether the partial file can be resumed
+    """
+    try:
+        with open(_partial_source(partial_file)) as f:
+            return json.load(f) == source
+    except (OSError, ValueError):
+        return False
+
+def retrieve(ftp, filename, output_dir, size=None, modify=None):
+    """Download a single file from the current folder of an FTP session.
+
+    The file is written to a hidden partial file, which is renamed into place
+    once the transfer completes. If a partial file is left over from an
+    interrupted transfer of the same version of the remote file, the download
+    is resumed from its size using a `REST` offset instead of starting over.
+    The size and modification time of the remote file are kept next to the
+    partial file, and a partial file taken from a different version is
+    discarded.
+
+    Args:
+        ftp (khp.implicitly_tls.tyFTP): Logged in FTP session
+        filename (str): Name of the file to download
+        output_dir (str): Directory to write the file to
+        size (:obj:`int`, optional): Size of the remote file, if known. A
+            partial file larger than this is discarded, and one of exactly
+            this size is treated as complete.
+        modify (:obj:`str`, optional): Modification time of the remote file,
+            as listed by the server, if known
+
+    Returns:
+        int: Number of bytes downloaded
+        str: SHA-256 hex digest of the file contents
+    """
+    output_file = os.path.join(output_dir, filename)
+    partial_file = _partial_path(output_dir, filename)
+    source = {'size': size, 'modify': modify}
+    checksum = hashlib.sha256()
+    offset = 0
+    if os.path.exists(partial_file):
+        offset = os.path.getsize(partial_file)
+        if not _resumable(partial_file, source):
+            LOG.warning("Discarding partial file for %s, the file on the "
+                        "server has changed", filename)
+            offset = 0
+        elif size is not None and offset > int(size):
+            LOG.warning("Discarding partial file for %s, %s bytes on disk "
+                        "but %s bytes on the server", filename, offset, size)
+            offset = 0
+        else:
+            # the checksum has to cover the bytes already on disk
+            with open(partial_file, "rb") as f:
+                for block in iter(lambda: f.read(config.FTP_BLOCKSIZE), b''):
+                    checksum.update(block)
+        if offset and size is not None and offset == int(size):
+            LOG.info("Partial file for %s is already complete", filename)
+            os.replace(partial_file, output_file)
+            os.remove(_partial_source(partial_file))
+            return 0, checksum.hexdigest()
+    if not offset:
+        with open(_partial_source(partial_file), "w") as f:
+            json.dump(source, f)
+
+    start = time.time()
+    if offset:
+        LOG.info("Resuming file %s from byte %s", filename, offset)
+        with open(partial_file, "ab") as f:
+            ftp.retrbinary_into("RETR " + filename, f, config.FTP_BLOCKSIZE,
+                                rest=offset, callback=checksum.update)
+    else:
+        LOG.debug("Writing file %s", filename)
+        with open(partial_file, "wb") as f:
+            ftp.retrbinary_into("RETR " + filename, f, config.FTP_BLOCKSIZE,
+                                callback=checksum.update)
+    elapsed = time.time() - start
+    os.replace(partial_file, output_file)
+    os.remove(_partial_source(partial_file))
+    nbytes = os.path.getsize(output_file) - offset
+    LOG.debug("Wrote file %s, %s bytes in %.2fs (%s)", filename, nbytes,
+              elapsed, _throughput(nbytes, elapsed))
+    return nbytes, checksum.hexdigest()
+
+def _transfer(pool, handler, incremental, retries, select=None):
+    """Run `handler` on every file in an FTP folder, concurrently over a pool
+    of sessions. See `download` for the meaning of the shared arguments.
+
+    Args:
+        pool (FTPPool): Pool of sessions in the folder to transfer files from
+        handler (function): Called as ``handler(ftp, filename, entry, claim)``
+            for each file, returning the number of bytes transferred. `entry`
+            holds the listed facts for the file, and the handler adds the
+            ``sha256`` of its contents. ``claim(sha256)`` returns the name of
+            an already ingested file with the same contents, or None.
+        incremental (bool): Only transfer new or changed files
+        retries (int): Number of times to retry a failed transfer
+        select (:obj:`function`, optional): Called with each filename,
+            returning False for files to leave out of the transfer
+
+    Returns:
+        list: Filenames transferred
+    """
+    folder = pool.folder
+    manifest = Manifest(config.FTP_MANIFEST_PATH) if incremental else None
+    start = time.time()
+    with pool.session() as ftp:
+        entries = list_entries(ftp)
+    LOG.debug('%s files found in folder %s', len(entries), folder)
+    filenames = sorted(filename for filename in entries
+                       if select is None or select(filename))
+    if incremental:
+        filenames = [
+            filename for filename in filenames
+            if not manifest.is_current(posixpath.join(folder, filename),
+                                       entries[filename])
+        ]
+        LOG.info('%s new or changed files in folder %s', len(filenames),
+                 folder)
+
+    def claim(sha256, filename):
+        if not incremental:
+            return None
+        return manifest.claim('sha256', sha256,
+                              posixpath.join(folder, filename))
+
+    def fetch(filename):
+        attempt = 0
+        while True:
+            try:
+                with pool.session() as ftp:
+                    nbytes = handler(ftp, filename, entries[filename],
+                                     lambda sha256: claim(sha256, filename))
+                break
+            except ftplib.all_errors as err:
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                LOG.warning("Transfer of %s failed (%s), retry %s of %s",
+                            filename, err, attempt, retries)
+                time.sleep(config.FTP_RETRY_WAIT * attempt)
+        if incremental:
+            manifest.update(posixpath.join(folder, filename),
+                            entries[filename])
+        return nbytes
+
+    try:
+        with ThreadPoolExecutor(max_workers=pool.size) as executor:
+            sizes = list(executor.map(fetch, filenames))
+    finally:
+        if incremental:
+            manifest.save()
+
+    elapsed = time.time() - start
+    LOG.info("Transferred %s files (%s bytes) from %s in %.2fs (%s)",
+             len(filenames), sum(sizes), folder, elapsed,
+             _throughput(sum(sizes), elapsed))
+    LOG.info("TLS handshakes: %s resumed, %s full",
+             pool.handshakes['resumed'], pool.handshakes['full'])
+    return filenames
+
+def download(folder, output_dir, max_connections=1, incremental=False,
+             retries=config.FTP_RETRIES, pool=None):
+    """Download files from a folder within the KHP FTP server. Files are
+    transferred concurrently over a pool of up to `max_connections` sessions.
+
+    In incremental mode, the size, modification time and SHA-256 checksum of
+    each downloaded file are recorded in the manifest at
+    `config.FTP_MANIFEST_PATH`, and only files that are new or have changed
+    since the last run are transferred. Files with the same contents as one
+    already ingested, such as a report re-published under a new name, are
+    deleted after download so they are never uploaded or loaded again.
+
+    Transfers that fail with an FTP or network error are retried up to
+    `retries` times on a fresh session, resuming from the bytes already
+    written.
 
     Args:
         folder (str): folder to download files from
+        output_dir (str): directory to write the files to
+        max_connections (:obj:`int`, optional): Maximum number of concurrent
+            FTP sessions. Defaults to 1, a single sequential session.
+        incremental (:obj:`bool`, optional): Only download new or changed
+            files. Defaults to False.
+        retries (:obj:`int`, optional): Number of times to retry a failed
+            transfer. Defaults to `config.FTP_RETRIES`.
+        pool (:obj:`FTPPool`, optional): Existing pool of sessions in
+            `folder` to transfer over, in place of `max_connections` new
+            sessions. The pool is left open.
+
+    Returns:
+        list: Filenames downloaded
     """
-    LOG.info('Downloading files from FTP folder %s', folder)
-    ftp_conf = CONF['ftp']
-    with tyFTP() as ftp:
-        LOG.debug("Connecting to host %s", ftp_conf['host'])
-        ftp.connect(host=ftp_conf['host'].encode("ascii"),
-                        port=ftp_conf['port'])
-        LOG.debug("Logging into host %s", ftp_conf['host'])
-        ftp.login(user=ftp_conf['user'], passwd=ftp_conf['pwd'])
-        LOG.debug("Switching to secure data connection")
-        ftp.prot_p()
-        ftp.cwd(folder)
-        files = []
-        ftp.retrlines("LIST", files.append)
-        LOG.debug('%s files found in folder %s', len(files), folder)
-        for ftp_file in files:
-            words = ftp_file.split(None, 8)
-            filename = words[-1].lstrip()
-            LOG.debug("Writing file %s" % filename)
-            output_file = os.path.join(output_dir, filename)
-            with open(output_file, "wb") as f:
-                ftp.retrbinary("RETR " + filename, f.write, 8*1024)
-
-def load_to_s3(prefix=None):
+    def handler(ftp, filename, entry, claim):
+        nbytes, entry['sha256'] = retrieve(ftp, filename, output_dir,
+                                           entry['size'], entry['modify'])
+        original = claim(entry['sha256'])
+        if original is not None:
+            LOG.info("%s has the same contents as %s, skipping", filename,
+                     original)
+            os.remove(os.path.join(output_dir, filename))
+        return nbytes
+
+    if pool is not None:
+        return _transfer(pool, handler, incremental, retries)
+
+    LOG.info('Downloading files from FTP folder %s with up to %s connections',
+             folder, max_connections)
+    with FTPPool(max_connections, folder) as pool:
+        return _transfer(pool, handler, incremental, retries)
+
+def s3_key_manifest(s3_bucket=S3_BUCKET):
+    """Open the local manifest of keys uploaded to an S3 bucket, which is
+    reconciled against a full listing every `config.S3_RECONCILE_INTERVAL`
+    seconds.
+
+    Args:
+        s3_bucket (:obj:`str`, optional): Name of the S3 bucket. Defaults to
+            the bucket in the config.
+
+    Returns:
+        khp.manifest.KeyManifest: Manifest of the keys in the bucket
+    """
+    return KeyManifest(config.S3_KEY_MANIFEST_PATH.format(bucket=s3_bucket),
+                       s3_bucket, max_age=config.S3_RECONCILE_INTERVAL)
+
+def stream_to_s3(ftp, filename, s3_bucket, claim=None, compression=None,
+                 key=None):
+    """Stream a single file from the current folder of an FTP session into an
+    S3 object, without staging it on disk. The SHA-256
+    checksum of the contents is stored in the ``sha256`` metadata of the
+    object.
+
+    Args:
+        ftp (khp.implicitly_tls.tyFTP): Logged in FTP session
+        filename (str): Name of the file to transfer
+        s3_bucket (str): Name of the S3 bucket
+        claim (:obj:`function`, optional): Called with the checksum once the
+            file has been read, returning the name of an already ingested
+            file with the same contents, in which case the upload is aborted.
+        compression (:obj:`str`, optional): Compress the object with one of
+            `utils.COMPRESSIONS`. Defaults to None.
+        key (:obj:`str`, optional): Key of the S3 object. Defaults to the
+            filename.
+
+    Returns:
+        int: Number of bytes transferred
+        str: SHA-256 hex digest of the file contents
+    """
+    LOG.debug("Streaming file %s to S3 bucket %s", filename, s3_bucket)
+    start = time.time()
+    checksum = hashlib.sha256()
+    writer = utils.S3MultipartWriter(s3_bucket, key or filename,
+                                     compression=compression)
+
+    def write(block):
+        checksum.update(block)
+        writer.write(block)
+
+    try:
+        ftp.retrbinary_into("RETR " + filename, blocksize=config.FTP_BLOCKSIZE,
+                            callback=write)
+    except BaseException:
+        writer.abort()
+        raise
+    original = claim(checksum.hexdigest()) if claim else None
+    if original is not None:
+        LOG.info("%s has the same contents as %s, skipping", filename,
+                 original)
+        writer.abort()
+    else:
+        writer.close(metadata={'sha256': checksum.hexdigest()})
+    elapsed = time.time() - start
+    LOG.debug("Streamed file %s, %s bytes in %.2fs (%s)", filename,
+              writer.size, elapsed, _throughput(writer.size, elapsed))
+    return writer.size, checksum.hexdigest()
+
+def transfer_to_s3(folder, s3_bucket=S3_BUCKET, prefix=None,
+                   max_connections=1, incremental=False,
+                   retries=config.FTP_RETRIES,
+                   compression=config.S3_COMPRESSION, pool=None,
+                   partitioned=config.S3_PARTITIONED):
+    """Transfer files from a folder within the KHP FTP server straight to S3.
+    Each file is fed from the FTP data connection into an S3 multipart upload
+    through a fixed size buffer, so nothing is written to
+    `config.FTP_OUTPUT_DIR` and memory use does not grow with file size.
+    Files already in the bucket are skipped. A failed transfer is retried
+    from the start of the file.
+
+    Args:
+        folder (str): folder to transfer files from
+        s3_bucket (:obj:`str`, optional): Name of the S3 bucket. Defaults to
+            the bucket in the config.
+        prefix (:obj:`str`, optional): Prefix of files to transfer. Defaults
+            to None.
+        max_connections (:obj:`int`, optional): Maximum number of concurrent
+            FTP sessions. Defaults to 1.
+        incremental (:obj:`bool`, optional): Only transfer new or changed
+            files, and skip files with the same contents as one already
+            ingested, as in `download`. Defaults to False.
+        retries (:obj:`int`, optional): Number of times to retry a failed
+            transfer. Defaults to `config.FTP_RETRIES`.
+        compression (:obj:`str`, optional): Compress objects with one of
+            `utils.COMPRESSIONS`. Defaults to `config.S3_COMPRESSION`.
+        pool (:obj:`FTPPool`, optional): Existing pool of sessions in
+            `folder` to transfer over, as in `download`.
+        partitioned (:obj:`bool`, optional): Key objects by report type and
+            date, see `utils.s3_key`. Defaults to `config.S3_PARTITIONED`.
+
+    Returns:
+        list: Filenames transferred
+    """
+    LOG.info('Streaming files from FTP folder %s to S3 bucket %s', folder,
+             s3_bucket)
+    uploaded = s3_key_manifest(s3_bucket)
+    names = {posixpath.basename(key) for key in uploaded.keys(prefix=prefix)}
+
+    def select(filename):
+        if prefix is not None and not filename.startswith(prefix):
+            return False
+        return filename not in names
+
+    def handler(ftp, filename, entry, claim):
+        originals = []
+
+        def claim_contents(sha256):
+            originals.append(claim(sha256))
+            return originals[-1]
+
+        key = utils.s3_key(filename, partitioned)
+        nbytes, entry['sha256'] = stream_to_s3(ftp, filename, s3_bucket,
+                                               claim_contents, compression,
+                                               key=key)
+        if originals[-1] is None:
+            uploaded.add([key])
+        return nbytes
+
+    try:
+        if pool is not None:
+            return _transfer(pool, handler, incremental, retries,
+                             select=select)
+        with FTPPool(max_connections, folder) as pool:
+            return _transfer(pool, handler, incremental, retries,
+                             select=select)
+    finally:
+        uploaded.save()
+
+def load_to_s3(prefix=None, compression=config.S3_COMPRESSION,
+               max_workers=config.S3_UPLOAD_WORKERS,
+               partitioned=config.S3_PARTITIONED):
     """Load the downloaded files to S3, that have not already been uploaded.
     Optionally specify a prefix to filter the files to be uploaded. For KHP,
     FTCI files are prefixed with V2, and CSI files are prefixed with V1.
 
     Args:
         prefix (str, optional): Prefix of files to load. Defaults to None.
+        compression (str, optional): Compress files on upload with one of
+            `utils.COMPRESSIONS`. Defaults to `config.S3_COMPRESSION`.
+        max_workers (int, optional): Number of files uploaded at once.
+            Defaults to `config.S3_UPLOAD_WORKERS`.
+        partitioned (bool, optional): Key files by report type and date, see
+            `utils.s3_key`. Defaults to `config.S3_PARTITIONED`.
+
+    Returns:
+        list: Files that failed to upload. They are left in
+        `config.FTP_OUTPUT_DIR`, to be retried by the next load.
     """
     LOG.info("Loadings files with prefix {0} to S3".format(prefix))
     s3_bucket = S3_BUCKET
-    keys = utils.get_s3_keys(s3_bucket)
+    uploaded = s3_key_manifest(s3_bucket)
+    # files are matched by name, whichever key layout they were uploaded with
+    keys = {posixpath.basename(key) for key in uploaded.keys(prefix=prefix)}
     # get all files from output dir that is not in keys
-    files = utils.search_path(config.FTP_OUTPUT_DIR, prefix=prefix)
+    like = ['^' + prefix] if prefix is not None else None
+    files = utils.search_path(config.FTP_OUTPUT_DIR, like=like)
     basenames = [os.path.basename(f) for f in files]
     unloaded_files = [os.path.join(config.FTP_OUTPUT_DIR, f)
-                        for f in list(set(basenames) - set(keys))]
+                        for f in list(set(basenames) - keys)]
+
+    # attach the checksums recorded during download as object metadata
+    manifest = Manifest(config.FTP_MANIFEST_PATH)
+    checksums = {posixpath.basename(key): entry.get('sha256')
+                 for key, entry in manifest.entries.items()}
+    metadata = {f: {'sha256': checksums[os.path.basename(f)]}
+                for f in unloaded_files
+                if checksums.get(os.path.basename(f))}
 
+    failed = []
     if len(unloaded_files) > 0:
-        utils.upload_to_s3(s3_bucket, unloaded_files)
+        results = utils.upload_to_s3(s3_bucket, unloaded_files,
+                                     metadata=metadata,
+                                     compression=compression,
+                                     max_workers=max_workers,
+                                     partitioned=partitioned)
+        failed = [result['file'] for result in results
+                  if result['error'] is not None]
+        uploaded.add([result['key'] for result in results
+                      if result['error'] is None])
     else:
         LOG.warning("No files to upload")
+    if failed:
+        LOG.error("%s files failed to upload to S3, keeping them for the "
+                  "next load", len(failed))
+    uploaded.save()
+
+    utils.clean_dir(config.FTP_OUTPUT_DIR, prefix=prefix, exclude=failed)
+    return failed
+
+def report_keys(report_type, day, s3_bucket=S3_BUCKET):
+    """Get the keys of the reports of a type dated on a day, from the
+    manifest of keys in the bucket.
+
+    Args:
+        report_type (str): Type of the reports, e.g. V1
+        day (datetime.date): Date of the reports
+        s3_bucket (:obj:`str`, optional): Name of the S3 bucket. Defaults to
+            the bucket in the config.
+
+    Returns:
+        list: Keys of the reports
+    """
+    uploaded = s3_key_manifest(s3_bucket)
+    keys = sorted(key for key in uploaded.keys(prefix=report_type)
+                  if utils.report_date(posixpath.basename(key)) == day)
+    uploaded.save()
+    return keys
 
-    utils.clean_dir(config.FTP_OUTPUT_DIR, prefix=prefix)
-
-#TODO: Refactor report loading into a class!
-def load_ftci_to_postgres():
-    # get all files from output dir that have already been loaded
-    db_conf = CONF['database']
-    query = """
-        SELECT report_name
-        FROM loaded_reports
-        WHERE report_type='FTCI' --AND load_dt > CURRENT_DATE - 2 -- can't add this part cuase files are still in S3
-    """
-    data = postgrez.execute(query=query, host=db_conf['host'],
-                user=db_conf['user'], password=db_conf['pwd'],
-                database=db_conf['db'])
-    loaded_files = [record['report_name'] for record in data]
+def compact_csi(day=None, delete_sources=False, s3_bucket=S3_BUCKET):
+    """Compact a day of CSI reports in S3 into a single compressed object,
+    see `khp.compaction`. Compacting a day again only adds the reports that
+    arrived since.
+
+    Args:
+        day (:obj:`datetime.date`, optional): Date of the reports. Defaults
+            to yesterday.
+        delete_sources (:obj:`bool`, optional): Delete the individual
+            reports once compacted. Only use with incremental downloads, or
+            `transfer_to_s3` will fetch them again. Defaults to False.
+        s3_bucket (:obj:`str`, optional): Name of the S3 bucket. Defaults to
+            the bucket in the config.
+
+    Returns:
+        dict: Index of the compacted object, see `compaction.read_index`
+    """
+    day = day or date.today() - timedelta(1)
+    keys = report_keys("V1", day, s3_bucket)
+    index = compaction.compact(s3_bucket, "V1", day, keys,
+                               delete_sources=delete_sources)
+    if index is not None:
+        uploaded = s3_key_manifest(s3_bucket)
+        uploaded.add(compaction.compacted_keys("V1", day))
+        if delete_sources:
+            uploaded.remove(keys)
+        uploaded.save()
+    return index
+
+def read_csi(day, s3_bucket=S3_BUCKET, keys=None):
+    """Read a day of CSI reports from S3, from the compacted object when the
+    day has been compacted.
+
+    Args:
+        day (datetime.date): Date of the reports
+        s3_bucket (:obj:`str`, optional): Name of the S3 bucket. Defaults to
+            the bucket in the config.
+        keys (:obj:`list`, optional): Keys of the reports to read. Defaults
+            to None, reading every report of the day.
+
+    Returns:
+        dict: Contents of each report, keyed by S3 key
+    """
+    if keys is None:
+        keys = report_keys("V1", day, s3_bucket)
+    return compaction.read_reports(s3_bucket, "V1", day, keys)
+
+def _keepalive(pool):
+    """Send a NOOP over the idle session of a pool. If the session has
+    dropped, it is discarded and a new one is opened in its place. Failures
+    to reconnect are logged, and retried at the next keepalive.
+    """
+    try:
+        with pool.session() as ftp:
+            ftp.voidcmd('NOOP')
+    except ftplib.all_errors as err:
+        LOG.warning("Keepalive failed (%s), reconnecting", err)
+        try:
+            with pool.session():
+                pass
+        except ftplib.all_errors as err:
+            LOG.error("Unable to reconnect (%s), retrying next poll", err)
+
+def poll(folder, prefix, interval=config.FTP_POLL_INTERVAL,
+         keepalive=config.FTP_KEEPALIVE_INTERVAL, cycles=None):
+    """Run a resident poller that keeps one authenticated session open to the
+    KHP FTP server. Every `interval` seconds, new files in `folder` are
+    downloaded incrementally and loaded to S3. Between polls the session is
+    kept alive with NOOPs, and it is re-opened transparently if it drops.
+
+    Args:
+        folder (str): folder to poll for new files
+        prefix (str): Prefix of the files to load to S3
+        interval (:obj:`int`, optional): Seconds between polls. Defaults to
+            `config.FTP_POLL_INTERVAL`.
+        keepalive (:obj:`int`, optional): Seconds between NOOPs. Defaults to
+            `config.FTP_KEEPALIVE_INTERVAL`.
+        cycles (:obj:`int`, optional): Number of polls to run before
+            returning. Defaults to None, poll forever.
+    """
+    LOG.info("Polling FTP folder %s every %ss", folder, interval)
+    cycle = 0
+    with FTPPool(1, folder) as pool:
+        while cycles is None or cycle < cycles:
+            start = time.time()
+            try:
+                download(folder, config.FTP_OUTPUT_DIR, incremental=True,
+                         pool=pool)
+                load_to_s3(prefix)
+            except Exception:
+                LOG.error("Poll of FTP folder %s failed", folder,
+                          exc_info=True)
+            cycle += 1
+            if cycles is not None and cycle >= cycles:
+                break
+            next_poll = start + interval
+            while time.time() + keepalive < next_poll:
+                time.sleep(keepalive)
+                try:
+                    _keepalive(pool)
+                except Exception:
+                    LOG.error("Keepalive of FTP folder %s failed", folder,
+                              exc_info=True)
+            time.sleep(max(0, next_poll - time.time()))
+
+def bulk_load(items, fetch, table, report_type,
+              batch_size=config.DB_BATCH_SIZE,
+              prefetch=config.S3_PREFETCH_DEPTH,
+              export_parquet=config.PARQUET_EXPORT, merge=True,
+              defer_indexes=None, on_batch=None):
+    """Bulk load reports into a table, in batches of `batch_size` reports.
+    Items (single reports, or groups of them) are fetched on a thread pool,
+    up to `prefetch` ahead of the batch being loaded, so S3 reads overlap
+    with the Postgres loads. The rows of each item are loaded a chunk at a
+    time as they are parsed, so memory use does not grow with the size of
+    the reports. Each batch is merged into the table (see `db.merge_frame`)
+    and recorded in loaded_reports in one transaction, so a failed batch
+    leaves nothing behind, and reloading a report never duplicates rows.
+
+    Args:
+        items (list): Items to fetch, e.g. the S3 keys of the reports
+        fetch (function): Called with each item, returning the names of the
+            reports it holds and an iterable of typed DataFrames of their
+            rows (see `khp.reports.iter_parse`)
+        table (str): Name of the table to load, one of `reports.TABLES`
+        report_type (str): Type recorded in loaded_reports, e.g. FTCI
+        batch_size (:obj:`int`, optional): Number of reports per
+            transaction. Defaults to `config.DB_BATCH_SIZE`.
+        prefetch (:obj:`int`, optional): Number of reports read ahead of
+            the load. Defaults to `config.S3_PREFETCH_DEPTH`.
+        export_parquet (:obj:`bool`, optional): Also export each batch as
+            Parquet, see `khp.export`. Defaults to `config.PARQUET_EXPORT`.
+        merge (:obj:`bool`, optional): Merge batches through the staging
+            table, skipping rows already loaded. Set to False for tables
+            without a unique constraint, to COPY batches straight into the
+            table. Defaults to True.
+        defer_indexes (:obj:`bool`, optional): Drop the secondary indexes
+            of the table for the load, and rebuild them at the end, see
+            `db.deferred_indexes`. Defaults to None, deferring them when
+            there are at least `config.DB_DEFER_INDEXES_MIN_REPORTS` items.
+            Otherwise, indexes left dropped by an earlier load that died are
+            rebuilt first.
+        on_batch (:obj:`function`, optional): Called with the cursor and each
+            chunk of rows, in the batch's transaction, once they are loaded.
+            Defaults to None.
+
+    Returns:
+        int: Number of rows inserted
+    """
+    if defer_indexes is None:
+        defer_indexes = len(items) >= config.DB_DEFER_INDEXES_MIN_REPORTS
+    load_frame = db.merge_frame if merge else db.copy_frame
+    start = time.time()
+    loaded = 0
+    inserted = 0
+    with db.connection() as conn, ExitStack() as stack:
+        if defer_indexes and items:
+            stack.enter_context(db.deferred_indexes(conn, table))
+        else:
+            db.restore_indexes(conn, table)
+        fetched = (result for _, result in utils.prefetch(fetch, items,
+                                                           depth=prefetch))
+
+        def load_batch():
+            batch = []
+            rows = 0
+            new_rows = 0
+            with conn, conn.cursor() as cursor:
+                for report_names, frames in fetched:
+                    for df in frames:
+                        new_rows += load_frame(cursor, df, table)
+                        rows += len(df)
+                        if on_batch is not None:
+                            on_batch(cursor, df)
+                        if export_parquet:
+                            export.write_parquet(
+                                df, table, 'part-{:%Y%m%d%H%M%S%f}'.format(
+                                    datetime.now()), s3_bucket=S3_BUCKET)
+                    batch.extend(report_names)
+                    if len(batch) >= batch_size:
+                        break
+                if batch:
+                    db.record_loaded_reports(cursor, batch, report_type)
+            if batch:
+                LOG.info("Loaded %s %s reports, %s of %s rows new",
+                         len(batch), report_type, new_rows, rows)
+            return len(batch), new_rows
+
+        while True:
+            reports_loaded, new_rows = load_batch()
+            if not reports_loaded:
+                break
+            loaded += reports_loaded
+            inserted += new_rows
+
+    elapsed = time.time() - start
+    LOG.info("Loaded %s %s reports (%s new rows) into %s in %.2fs",
+             loaded, report_type, inserted, table, elapsed)
+    return inserted
+
+def unloaded_keys(prefix, report_type, start_date=None, end_date=None):
+    """Get the keys of the reports in S3 that are not yet recorded in
+    loaded_reports.
+
+    Args:
+        prefix (str): Prefix of the reports, e.g. V2
+        report_type (str): Type recorded in loaded_reports, e.g. FTCI
+        start_date (:obj:`str`, optional): Only list reports dated on or
+            after this date, `YYYY-mm-dd`, from the partitions in the window
+            (see `utils.get_s3_keys_between`). Defaults to None, listing
+            every report from the key manifest.
+        end_date (:obj:`str`, optional): Only list reports dated on or before
+            this date, `YYYY-mm-dd`. Without `start_date`, reports from the
+            key manifest are filtered by the date in their name. Defaults to
+            today with `start_date`, otherwise None, no upper bound.
+
+    Returns:
+        list: Sorted keys of the reports
+    """
+    with db.connection() as conn, conn.cursor() as cursor:
+        loaded_files = db.loaded_reports(cursor, report_type)
     # get files from S3 matching prefix
-    files = utils.get_s3_keys(S3_BUCKET, prefix="V2")
-
-    unloaded_files = list(set(files) - set(loaded_files))
-
-    loaded_reports = []
-    with postgrez.Load(
-            host=db_conf['host'], user=db_conf['user'],
-            password=db_conf['pwd'], database=db_conf['db']) as load:
-        for key in unloaded_files:
-            contents = utils.read_s3_file(S3_BUCKET, key)
-            if contents == '':
-                loaded_reports.append(key)
-                continue
-            parsed_contents = utils.parse_s3_contents(contents, '|',
-                                                        remove_dupes=True)
-            load.load_from_object(table_name='ftci',
-                                    data=parsed_contents)
-            loaded_reports.append(key)
-
-        ## TODO: if one of these queries above fails, the loaded reports part below doesn't run...
-        if len(loaded_reports) > 0:
-            dt = datetime.now()
-            load_data = [[dt, report_name, 'FTCI']
-                            for report_name in loaded_reports]
-            load.load_from_object(table_name='loaded_reports', data=load_data)
+    if start_date is not None:
+        end_date = end_date or date.today().isoformat()
+        files = set(utils.get_s3_keys_between(S3_BUCKET, prefix, start_date,
+                                              end_date))
+    else:
+        uploaded = s3_key_manifest(S3_BUCKET)
+        files = uploaded.keys(prefix=prefix)
+        uploaded.save()
+        if end_date is not None:
+            end = datetime.strptime(end_date, '%Y-%m-%d').date()
+            files = {key for key in files
+                     if (utils.report_date(posixpath.basename(key))
+                         or date.max) <= end}
+    return sorted(files - loaded_files)
+
+def _report_fetcher(table):
+    """Get a `bulk_load` fetch function that streams a single report from
+    S3 and parses it for a table a block at a time, see
+    `reports.iter_parse`."""
+
+    def frames(report):
+        with closing(report):
+            yield from reports.iter_parse(report, table, remove_dupes=True)
+
+    def fetch(key):
+        return [key], frames(utils.open_s3_file(S3_BUCKET, key))
+
+    return fetch
+
+def load_ftci_to_postgres(start_date=None, end_date=None,
+                          export_parquet=config.PARQUET_EXPORT,
+                          prefetch=config.S3_PREFETCH_DEPTH,
+                          batch_size=config.DB_BATCH_SIZE):
+    """Load FTCI reports from S3 into the ftci table, skipping reports already
+    recorded in loaded_reports. See `bulk_load`.
+
+    The agent state transitions in ftci_summary are refreshed with each
+    batch, from the rows it loaded (see `khp.summary`). Loads that defer
+    index maintenance instead rebuild the summary once, at the end.
+
+    Args:
+        start_date (:obj:`str`, optional): Only load reports dated on or after
+            this date, `YYYY-mm-dd`. Only the partitions in the window are
+            then listed, which requires the partitioned layout (see
+            `utils.s3_key`). Defaults to None, loading every report.
+        end_date (:obj:`str`, optional): Only load reports dated on or before
+            this date, `YYYY-mm-dd`. Defaults to today with `start_date`,
+            otherwise None, no upper bound.
+        export_parquet (:obj:`bool`, optional): Also export the loaded rows
+            as Parquet, see `khp.export`. Defaults to
+            `config.PARQUET_EXPORT`.
+        prefetch (:obj:`int`, optional): Number of reports read ahead of
+            the load. Defaults to `config.S3_PREFETCH_DEPTH`.
+        batch_size (:obj:`int`, optional): Number of reports per
+            transaction. Defaults to `config.DB_BATCH_SIZE`.
+
+    Returns:
+        int: Number of rows inserted
+    """
+    unloaded_files = unloaded_keys("V2", 'FTCI', start_date, end_date)
+    # without the index on dt, each incremental refresh would scan the table
+    defer_indexes = (len(unloaded_files)
+                     >= config.DB_DEFER_INDEXES_MIN_REPORTS)
+    try:
+        return bulk_load(unloaded_files, _report_fetcher('ftci'), 'ftci',
+                         'FTCI', batch_size=batch_size, prefetch=prefetch,
+                         export_parquet=export_parquet,
+                         defer_indexes=defer_indexes,
+                         on_batch=(None if defer_indexes
+                                   else summary.refresh_ftci_summary))
+    finally:
+        if defer_indexes:
+            with db.connection() as conn, conn, conn.cursor() as cursor:
+                summary.rebuild_ftci_summary(cursor)
+
+def load_csi_to_postgres(start_date=None, end_date=None,
+                         export_parquet=config.PARQUET_EXPORT,
+                         prefetch=config.S3_PREFETCH_DEPTH,
+                         batch_size=config.DB_BATCH_SIZE):
+    """Load new CSI reports from S3 into the csi table, skipping reports
+    already recorded in loaded_reports. Each line of a CSI report is a
+    ``dt|queue_id|metric|value`` row. See `bulk_load`.
+
+    Reports are fetched a day at a time: from the compacted object for days
+    compacted by `compact_csi`, so a backlog of several days costs a couple
+    of requests per day, and otherwise concurrently, report by report. Each
+    day's reports are parsed together in one pass.
+
+    Args:
+        start_date (:obj:`str`, optional): Only load reports dated on or after
+            this date, `YYYY-mm-dd`. Only the partitions in the window are
+            then listed, which requires the partitioned layout (see
+            `utils.s3_key`). Defaults to None, loading every report.
+        end_date (:obj:`str`, optional): Only load reports dated on or before
+            this date, `YYYY-mm-dd`. Defaults to today with `start_date`,
+            otherwise None, no upper bound.
+        export_parquet (:obj:`bool`, optional): Also export the loaded rows
+            as Parquet, see `khp.export`. Defaults to
+            `config.PARQUET_EXPORT`.
+        prefetch (:obj:`int`, optional): Number of days read ahead of the
+            load. Defaults to `config.S3_PREFETCH_DEPTH`.
+        batch_size (:obj:`int`, optional): Number of reports per
+            transaction. Defaults to `config.DB_BATCH_SIZE`.
+
+    Returns:
+        int: Number of rows inserted
+    """
+    unloaded_files = unloaded_keys("V1", 'CSI', start_date, end_date)
+    days = {}
+    for key in unloaded_files:
+        days.setdefault(utils.report_date(posixpath.basename(key)),
+                        []).append(key)
+
+    def fetch(item):
+        day, keys = item
+        if day is None:
+            contents = [utils.read_s3_file(S3_BUCKET, key) for key in keys]
+        else:
+            day_reports = read_csi(day, S3_BUCKET, keys)
+            contents = [day_reports[key] for key in keys]
+        # reports may not end with a line break, so join them with one
+        data = '\r\n'.join(contents).encode('utf-8')
+        return keys, reports.iter_parse(data, 'csi', remove_dupes=True)
+
+    items = sorted(days.items(), key=lambda item: (item[0] is None, item[0]
+                                                   or date.min))
+    defer_indexes = (len(unloaded_files)
+                     >= config.DB_DEFER_INDEXES_MIN_REPORTS)
+    return bulk_load(items, fetch, 'csi', 'CSI', batch_size=batch_size,
+                     prefetch=prefetch, export_parquet=export_parquet,
+                     defer_indexes=defer_indexes)
+
+def load_stat_to_postgres(table, start_date=None, end_date=None,
+                          export_parquet=config.PARQUET_EXPORT,
+                          prefetch=config.S3_PREFETCH_DEPTH,
+                          batch_size=config.DB_BATCH_SIZE):
+    """Load new agent (ADR) or contact (CDR) event reports from S3 into
+    their stat table, skipping reports already recorded in loaded_reports.
+    Reports are found by their prefix in `STAT_PREFIXES`. See `bulk_load`.
+
+    The stat tables have no unique constraint, so batches are copied
+    straight into them, and a report is never loaded twice because it is
+    recorded in loaded_reports in the same transaction. Backfills of at
+    least `config.DB_DEFER_INDEXES_MIN_REPORTS` reports rebuild the table's
+    indexes once at the end, instead of updating them row by row.
+
+    Args:
+        table (str): Name of the table, ``stat_adr`` or ``stat_cdr``
+        start_date (:obj:`str`, optional): Only load reports dated on or after
+            this date, `YYYY-mm-dd`. See `load_ftci_to_postgres`. Defaults to
+            None, loading every report.
+        end_date (:obj:`str`, optional): Only load reports dated on or before
+            this date, `YYYY-mm-dd`. Defaults to today with `start_date`,
+            otherwise None, no upper bound.
+        export_parquet (:obj:`bool`, optional): Also export the loaded rows
+            as Parquet, see `khp.export`. Defaults to
+            `config.PARQUET_EXPORT`.
+        prefetch (:obj:`int`, optional): Number of reports read ahead of
+            the load. Defaults to `config.S3_PREFETCH_DEPTH`.
+        batch_size (:obj:`int`, optional): Number of reports per
+            transaction. Defaults to `config.DB_BATCH_SIZE`.
+
+    Returns:
+        int: Number of rows inserted
+    """
+    prefix = STAT_PREFIXES[table]
+    unloaded_files = unloaded_keys(prefix, prefix, start_date, end_date)
+    return bulk_load(unloaded_files, _report_fetcher(table), table, prefix,
+                     batch_size=batch_size, prefetch=prefetch,
+                     export_parquet=export_parquet, merge=False)
 
 def main():
     config.log_ascii()
     ## CSI Files
     ## Run every 10 minutes
-    download('CSI_files', config.FTP_OUTPUT_DIR)
+    download('CSI_files', config.FTP_OUTPUT_DIR, incremental=True)
     load_to_s3("V1")
+    ## Compact yesterday once, on the first run of the day
+    yesterday = date.today() - timedelta(1)
+    if compaction.read_index(S3_BUCKET, "V1", yesterday) is None:
+        compact_csi(yesterday)
+    load_csi_to_postgres()
 
     ## FTCI Files
     ## Run twice per day
-    download('FTCI_files/Archive', config.FTP_OUTPUT_DIR)
+    download('FTCI_files/Archive', config.FTP_OUTPUT_DIR,
+             max_connections=config.FTP_MAX_CONNECTIONS, incremental=True)
     load_to_s3("V2")
     load_ftci_to_postgres()
 
+    ## Stat Files
+    ## Not on the FTP server, loaded from the reports already in S3
+    for table in STAT_PREFIXES:
+        load_stat_to_postgres(table)
+
 ## TODO: make sure your read from s3 method is returning more than 1000
@@ -36,6 +36,7 @@ python ftplib.py -d localhost -l -p -l
 # Modified by Giampaolo Rodola' to add TLS support.
 #
 
+import os
 import sys
 import socket
 from socket import _GLOBAL_DEFAULT_TIMEOUT
@@ -451,6 +452,46 @@ class FTP:
                 conn.unwrap()
         return self.voidresp()
 
+    def retrbinary_into(self, cmd, fp=None, blocksize=1048576, rest=None,
+                        callback=None):
+        """Retrieve data in binary mode, without allocating per block.
+        Blocks are read with recv_into() into one preallocated buffer and
+        written straight to the file descriptor of `fp`.
+
+        Args:
+          cmd: A RETR command.
+          fp: A binary file object opened for writing, or None to only
+              call `callback`.
+          blocksize: The size of the receive buffer.  [default: 1048576]
+          rest: Passed to transfercmd().  [default: None]
+          callback: An optional single parameter callable, called with a
+                    memoryview of each block of data read.  The view is
+                    only valid for the duration of the call.
+
+        Returns:
+          The response code.
+        """
+        self.voidcmd('TYPE I')
+        view = memoryview(bytearray(blocksize))
+        fd = None
+        if fp is not None:
+            fp.flush()
+            fd = fp.fileno()
+        with self.transfercmd(cmd, rest) as conn:
+            while 1:
+                nbytes = conn.recv_into(view)
+                if not nbytes:
+                    break
+                block = view[:nbytes]
+                if callback is not None:
+                    callback(block)
+                while fd is not None and block:
+                    block = block[os.write(fd, block):]
+            # shutdown ssl layer
+            if _SSLSocket is not None and isinstance(conn, _SSLSocket):
+                conn.unwrap()
+        return self.voidresp()
+
     def retrlines(self, cmd, callback = None):
         """Retrieve data in line mode.  A new port is created for you.
 
@@ -7,20 +7,57 @@ https://stackoverflow.com/questions/12164470/python-ftp-implicit-tls-connection-
 """
 
 import logging
-import ftplib_mod as ftplib
+from collections import Counter
+from khp import ftplib_mod as ftplib
 import socket
 import ssl
 
 log = logging.getLogger(__name__)
 
+def create_context(keyfile=None, certfile=None):
+    """Create an SSL context for connecting to the KHP FTP server. A single
+    context can be shared by any number of sessions, which lets TLS sessions
+    be cached and resumed across connections.
+
+    Args:
+        keyfile (str, optional): Path of the client private key
+        certfile (str, optional): Path of the client certificate
+
+    Returns:
+        ssl.SSLContext: Client SSL context
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    # the KHP server certificate is not verified, as before
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    if certfile is not None:
+        context.load_cert_chain(certfile, keyfile)
+    return context
+
 class tyFTP(ftplib.FTP_TLS):
+    """FTP client for servers that use implicit TLS. Data connections resume
+    the TLS session negotiated on the control connection, so each transfer
+    avoids a full handshake.
 
-    def __init__(self, host='', user='', passwd='', acct='', keyfile=None,
-                    certfile=None, timeout=60):
+    Attributes:
+        handshakes (collections.Counter): Number of `full` and `resumed` TLS
+            handshakes performed by this session
+    """
 
+    def __init__(self, host='', user='', passwd='', acct='', keyfile=None,
+                    certfile=None, context=None, timeout=60):
+        if context is None:
+            context = create_context(keyfile, certfile)
+        self.handshakes = Counter()
         ftplib.FTP_TLS.__init__(self, host=host, user=user, passwd=passwd,
-                                    acct=acct, keyfile=keyfile,
-                                    certfile=certfile, timeout=timeout)
+                                    acct=acct, context=context,
+                                    timeout=timeout)
+
+    def _count_handshake(self, sock):
+        kind = 'resumed' if sock.session_reused else 'full'
+        self.handshakes[kind] += 1
+        log.debug("TLS handshake on %s connection: %s",
+                  'data' if sock is not self.sock else 'control', kind)
 
     def connect(self, host='', port=0, timeout=-999):
         """Connect to FTP host.
@@ -42,16 +79,32 @@ class tyFTP(ftplib.FTP_TLS):
             self.sock = socket.create_connection((self.host, self.port),
                                                     self.timeout)
             self.af = self.sock.family
-            self.sock = ssl.wrap_socket(self.sock,
-                                        self.keyfile,
-                                        self.certfile,
-                                        ssl_version=ssl.PROTOCOL_TLSv1)
+            self.sock = self.context.wrap_socket(self.sock,
+                                                 server_hostname=self.host)
+            self._count_handshake(self.sock)
             self.file = self.sock.makefile('rb')
             self.welcome = self.getresp()
         except Exception as e:
-            log.error("Unable to connect due to error: %s" % e, exc_info=True)
+            log.error("Unable to connect due to error: %s" % e)
+            self.close()
+            raise
         return self.welcome
 
+    def ntransfercmd(self, cmd, rest=None):
+        """Initiate a transfer over the data connection, protecting it with
+        TLS if `prot_p` was called. The TLS session of the control connection
+        is offered for resumption.
+
+        Returns:
+            tuple: Socket for the data connection and the expected size of
+                the transfer, which may be None
+        """
+        conn, size = ftplib.FTP.ntransfercmd(self, cmd, rest)
+        if self._prot_p:
+            conn = self.context.wrap_socket(conn, server_hostname=self.host,
+                                            session=self.sock.session)
+            self._count_handshake(conn)
+        return conn, size
 
     def __enter__(self):
         return self
@@ -0,0 +1,198 @@
+"""
+Persisted manifests, used to remember which files have already been processed
+between runs of the pipeline.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from khp import utils
+
+LOGGER = logging.getLogger(__name__)
+
+class Manifest():
+    """A dictionary of entries, keyed by file name, persisted as a json file.
+    Access is guarded by a lock so entries can be updated from worker threads.
+
+    Attributes:
+        path (str): Path of the json file backing the manifest
+        entries (dict): Manifest entries, keyed by file name
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._claims = {}
+        if os.path.exists(path):
+            self.entries = utils.read_jason(path)
+        else:
+            LOGGER.info("No manifest found at %s, starting a new one", path)
+            self.entries = {}
+
+    def get(self, key):
+        """Get the entry for a key.
+
+        Args:
+            key (str): Name of the entry
+
+        Returns:
+            dict: The entry, or None if the key is not in the manifest
+        """
+        with self._lock:
+            return self.entries.get(key)
+
+    def update(self, key, entry):
+        """Add or replace the entry for a key.
+
+        Args:
+            key (str): Name of the entry
+            entry (dict): Entry to store
+        """
+        with self._lock:
+            self.entries[key] = entry
+
+    def is_current(self, key, entry):
+        """Check whether the manifest already holds an identical entry for a
+        key.
+
+        Args:
+            key (str): Name of the entry
+            entry (dict): Entry to compare against
+
+        Returns:
+            bool: True if the stored entry matches on every field of `entry`
+        """
+        stored = self.get(key)
+        if stored is None:
+            return False
+        return all(stored.get(field) == value for field, value in entry.items())
+
+    def claim(self, field, value, key):
+        """Claim a value of a field for a key, unless another entry already
+        holds the same value. Used to detect files whose contents have
+        already been seen under a different name.
+
+        Args:
+            field (str): Name of the field, e.g. ``sha256``
+            value (str): Value of the field
+            key (str): Name of the entry claiming the value
+
+        Returns:
+            str: Key of the entry already holding the value, or None if the
+                value is new or already held by `key`
+        """
+        with self._lock:
+            if field not in self._claims:
+                self._claims[field] = {
+                    entry[field]: name for name, entry in self.entries.items()
+                    if entry.get(field) is not None
+                }
+            original = self._claims[field].setdefault(value, key)
+        return None if original == key else original
+
+    def save(self):
+        """Write the manifest to disk. The file is replaced atomically so an
+        interrupted run never leaves a truncated manifest behind.
+        """
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            utils.write_jason(self._dump(), tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def _dump(self):
+        """Contents of the json file, called with the lock held."""
+        return self.entries
+
+class KeyManifest(Manifest):
+    """Manifest of the keys in an S3 bucket, so finding which files have
+    already been uploaded does not need a listing of the whole bucket. Keys
+    are added as objects are uploaded, and the manifest is reconciled against
+    a full listing of the bucket once it is older than `max_age`, to pick up
+    objects written or deleted by other processes.
+
+    Attributes:
+        path (str): Path of the json file backing the manifest
+        s3_bucket (str): Name of the S3 bucket
+        max_age (int): Seconds between reconciliations, or None to only
+            reconcile a new manifest
+        reconciled (float): Time of the last reconciliation, or None
+        entries (dict): Manifest entries, keyed by S3 key
+    """
+
+    def __init__(self, path, s3_bucket, max_age=None):
+        super().__init__(path)
+        self.s3_bucket = s3_bucket
+        self.max_age = max_age
+        state = self.entries
+        if state.get('s3_bucket') == s3_bucket:
+            self.reconciled = state.get('reconciled')
+            self.entries = state.get('keys', {})
+        else:
+            self.reconciled = None
+            self.entries = {}
+
+    @property
+    def stale(self):
+        """bool: True if the manifest is due to be reconciled"""
+        if self.reconciled is None:
+            return True
+        if self.max_age is None:
+            return False
+        return time.time() - self.reconciled > self.max_age
+
+    def reconcile(self):
+        """Replace the keys in the manifest with a full listing of the
+        bucket."""
+        keys = utils.get_s3_keys(self.s3_bucket)
+        with self._lock:
+            added = len(set(keys) - set(self.entries))
+            removed = len(set(self.entries) - set(keys))
+            self.entries = {key: self.entries.get(key, {}) for key in keys}
+            self._claims = {}
+            self.reconciled = time.time()
+        LOGGER.info("Reconciled manifest of S3 bucket %s: %s keys, %s added, "
+                    "%s removed", self.s3_bucket, len(keys), added, removed)
+
+    def add(self, keys):
+        """Record keys that have been uploaded to the bucket.
+
+        Args:
+            keys (list): S3 keys
+        """
+        uploaded = time.time()
+        with self._lock:
+            for key in keys:
+                self.entries[key] = {'uploaded': uploaded}
+
+    def remove(self, keys):
+        """Forget keys that have been deleted from the bucket.
+
+        Args:
+            keys (list): S3 keys
+        """
+        with self._lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def keys(self, prefix=None):
+        """Get the keys in the bucket, reconciling the manifest first if it is
+        stale.
+
+        Args:
+            prefix (:obj:`str`, optional): Only return keys starting with
+                this prefix. Defaults to None.
+
+        Returns:
+            set: Keys in the S3 bucket
+        """
+        if self.stale:
+            self.reconcile()
+        with self._lock:
+            return {key for key in self.entries
+                    if prefix is None or key.startswith(prefix)}
+
+    def _dump(self):
+        return {'s3_bucket': self.s3_bucket, 'reconciled': self.reconciled,
+                'keys': self.entries}
@@ -1,38 +1,40 @@
 /*
 This query is designed to summarize agent metadata.
 
-For each agent_id,
+For each agent_id, every pair of consecutive events is a transition from the
+first event's code to the second's, e.g. 1-2-->3-1, that took the time
+between them. ftci_summary holds the count of each transition and the time
+spent in it (in minutes) per agent. It is refreshed incrementally as FTCI
+reports are loaded, see khp.summary, so this only aggregates it.
 
 */
-create temporary table ranks as (
-	select
-		agent_id,
-		evt_cd_1||'-'||evt_cd_2 as evt_cd,
-		dt,
-		ROW_NUMBER() OVER (PARTITION BY agent_id ORDER BY dt ASC) as row_num
-	from ftci
-)
+select
+	evt,
+	sum(cnt) as cnt,
+	sum(time_spent) as time_spent
+from ftci_summary
+group by 1
 ;
 
+/*
+The same summary computed from scratch, for checking. LAG() reads each
+agent's previous event in a single pass over ftci.
+*/
 select
-	evt_cd_1||'-->'||evt_cd_2 AS evt,
+	prev_evt||'-->'||evt AS evt,
 	count(*) cnt,
 	sum(delta) as time_spent
 from (
   select
-  	r1.agent_id,
-  	r1.evt_cd AS evt_cd_1,
-  	r2.evt_cd as evt_cd_2,
-  --	r2.dt - r1.dt AS delta,
-  	ROUND(CAST(EXTRACT(seconds from (r2.dt - r1.dt))/60 +
-          EXTRACT(minutes from (r2.dt - r1.dt)) +
-          EXTRACT(hours from (r2.dt - r1.dt))*60 AS decimal),2) as delta
-  from ranks as r1
-  join ranks as r2
-  on
-  	r1.agent_id=r2.agent_id
-  	AND r1.row_num=r2.row_num-1
+  	agent_id,
+  	evt_cd_1||'-'||evt_cd_2 as evt,
+  	LAG(evt_cd_1||'-'||evt_cd_2) OVER w as prev_evt,
+  	ROUND(CAST(EXTRACT(epoch from dt - LAG(dt) OVER w)/60 AS decimal),2)
+  	  as delta
+  from ftci
+  WINDOW w AS (PARTITION BY agent_id ORDER BY dt, evt_cd_1, evt_cd_2)
   ) as summary
+where prev_evt is not null
 group by 1
 ;
 
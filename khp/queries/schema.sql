@@ -8,6 +8,14 @@ CREATE TABLE loaded_reports (
 -- hash index since we will only be using = operator
 CREATE INDEX loaded_reports_report_type ON loaded_reports USING hash (report_type);
 
+-- indexes dropped for a bulk load, until they are rebuilt
+CREATE TABLE deferred_indexes (
+    index_name VARCHAR(200) PRIMARY KEY,
+    table_name VARCHAR(200),
+    definition TEXT
+)
+;
+
 CREATE TABLE ftci (
   agent_id INTEGER,
   evt_cd_1 INTEGER,
@@ -25,6 +33,25 @@ CREATE INDEX ftci_agent_id ON ftci USING hash (agent_id);
 CREATE INDEX ftci_evt_cd_1 ON ftci USING (evt_cd_1);
 CREATE INDEX ftci_dt ON ftci USING (dt);
 
+-- agent state transitions, maintained by khp.summary
+CREATE TABLE ftci_summary (
+  agent_id INTEGER,
+  evt VARCHAR(50),
+  cnt INTEGER,
+  time_spent DECIMAL(12,2),
+  PRIMARY KEY (agent_id, evt)
+)
+;
+
+-- last summarized event of each agent
+CREATE TABLE ftci_summary_agents (
+  agent_id INTEGER PRIMARY KEY,
+  evt_cd_1 INTEGER,
+  evt_cd_2 INTEGER,
+  dt TIMESTAMP
+)
+;
+
 
 CREATE TABLE csi (
   dt TIMESTAMP,
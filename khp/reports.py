@@ -0,0 +1,306 @@
+"""
+Formats of the reports loaded into Postgres, and vectorized parsers that read
+them into typed DataFrames ready to load or export.
+
+FTCI, CSI and stat (ADR and CDR) reports are pipe delimited, with
+``\\r\\n`` line endings and no header. Their columns match the ``ftci``,
+``csi``, ``stat_adr`` and ``stat_cdr`` tables in ``khp/queries/schema.sql``.
+Stat event fields are often empty, so their integer columns are nullable.
+
+Example:
+
+>>> from khp import reports
+>>> df = reports.parse(b'1001|1|2|2018-10-01 12:00:00\\r\\n', 'ftci')
+>>> df.dtypes.to_dict()
+{'agent_id': dtype('int32'), 'evt_cd_1': dtype('int32'),
+ 'evt_cd_2': dtype('int32'), 'dt': dtype('<M8[ns]')}
+"""
+
+import io
+import logging
+
+import numpy as np
+import pandas as pd
+
+from khp import config
+
+try:
+    import pyarrow
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
+LOGGER = logging.getLogger(__name__)
+
+DELIMITER = '|'
+
+# columns and types of each report, matching khp/queries/schema.sql
+TABLES = {
+    'ftci': {
+        'agent_id': 'int32',
+        'evt_cd_1': 'int32',
+        'evt_cd_2': 'int32',
+        'dt': 'datetime64[ns]',
+    },
+    'csi': {
+        'dt': 'datetime64[ns]',
+        'queue_id': 'int32',
+        'metric': 'str',
+        'value': 'int32',
+    },
+    # unquoted identifiers are folded to lower case by Postgres
+    'stat_adr': {
+        'primarykey': 'str',
+        'eventtime': 'datetime64[ns]',
+        'dststatus': 'Int32',
+        'switchid': 'Int32',
+        'agentid': 'Int32',
+        'eventtype': 'Int32',
+        'eventid': 'Int32',
+        'currentstate': 'Int32',
+        'laststate': 'Int32',
+        'laststateduration': 'Int32',
+        'queueid': 'Int32',
+        'contactid': 'Int32',
+        'contacttype': 'Int32',
+        'routetype': 'Int32',
+        'targetid': 'Int32',
+        'reason': 'Int32',
+        'diallednumber': 'Int64',
+        'associatedqueueid': 'Int32',
+        'agentcalltype': 'Int32',
+        'eventsequence': 'Int32',
+    },
+    'stat_cdr': {
+        'primarykey': 'str',
+        'eventtime': 'datetime64[ns]',
+        'dststatus': 'Int32',
+        'contactid': 'Int32',
+        'eventid': 'Int32',
+        'switchid': 'Int32',
+        'contacttype': 'Int32',
+        'currentstate': 'Int32',
+        'laststate': 'Int32',
+        'laststateduration': 'Int32',
+        'queueid': 'Int32',
+        'intdata1': 'Int32',
+        'intdata2': 'Int32',
+        'intdata3': 'Int32',
+        'intdata4': 'Int32',
+        'eventsequence': 'Int32',
+    },
+}
+
+def _datetime_columns(table):
+    return [column for column, dtype in TABLES[table].items()
+            if dtype.startswith('datetime')]
+
+def _nullable(dtype):
+    """Whether a type is one of pandas' nullable integer types, e.g. Int32."""
+    return dtype.startswith('Int')
+
+def date_column(table):
+    """Get the column holding the time of each row of a table.
+
+    Args:
+        table (str): Name of the table, one of `TABLES`
+
+    Returns:
+        str: Name of the column, e.g. ``dt``
+    """
+    return _datetime_columns(table)[0]
+
+def _typed(df, table):
+    """Cast the columns of a DataFrame to the types of a table."""
+    for column, dtype in TABLES[table].items():
+        if dtype.startswith('datetime'):
+            df[column] = pd.to_datetime(df[column])
+        elif _nullable(dtype):
+            df[column] = df[column].replace('', None).astype(dtype)
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+def to_frame(rows, table):
+    """Convert parsed report rows into a typed DataFrame.
+
+    Args:
+        rows (list): List of lists of strings, in the column order of the
+            table, e.g. from `utils.parse_s3_contents`
+        table (str): Name of the table, one of `TABLES`
+
+    Returns:
+        pandas.DataFrame: Rows with the column names and types of the table
+    """
+    return _typed(pd.DataFrame(rows, columns=list(TABLES[table])), table)
+
+def _arrow_type(dtype):
+    if dtype.startswith('datetime'):
+        return pyarrow.timestamp('ns')
+    if dtype == 'str':
+        return pyarrow.string()
+    return pyarrow.from_numpy_dtype(dtype.lower())
+
+def _arrow_options(table, block_size=None):
+    """Options for pyarrow's CSV reader, with the column types of a table
+    given up front."""
+    columns = TABLES[table]
+    read_options = pyarrow.csv.ReadOptions(column_names=list(columns))
+    if block_size is not None:
+        read_options.block_size = block_size
+    return dict(
+        read_options=read_options,
+        parse_options=pyarrow.csv.ParseOptions(delimiter=DELIMITER),
+        convert_options=pyarrow.csv.ConvertOptions(column_types={
+            column: _arrow_type(dtype) for column, dtype in columns.items()}))
+
+def _arrow_frame(arrow_data, table):
+    """Convert a pyarrow table or record batch to a typed DataFrame."""
+    df = arrow_data.to_pandas()
+    # integer columns with nulls come back as floats
+    for column, dtype in TABLES[table].items():
+        if _nullable(dtype):
+            df[column] = df[column].astype(dtype)
+    return df
+
+def _read_arrow(data, table):
+    """Read a report with pyarrow's multithreaded CSV reader."""
+    # pandas' pyarrow engine drops a lone final line with no line break, so
+    # pyarrow.csv is called directly, with the column types given up front
+    try:
+        arrow_table = pyarrow.csv.read_csv(data, **_arrow_options(table))
+    except pyarrow.ArrowInvalid as err:
+        if 'Empty CSV file' not in str(err):
+            raise
+        return None
+    if not arrow_table.num_rows:
+        return None
+    return _arrow_frame(arrow_table, table)
+
+def _iter_arrow(data, table, block_size):
+    """Read a report a block at a time with pyarrow's streaming CSV reader."""
+    try:
+        reader = pyarrow.csv.open_csv(data, **_arrow_options(table,
+                                                             block_size))
+    except pyarrow.ArrowInvalid as err:
+        if 'Empty CSV file' not in str(err):
+            raise
+        return
+    for batch in reader:
+        if batch.num_rows:
+            yield _arrow_frame(batch, table)
+
+def _read_c(data, table):
+    """Read a report with pandas' C parser."""
+    columns = TABLES[table]
+    dates = _datetime_columns(table)
+    try:
+        df = pd.read_csv(
+            data, sep=DELIMITER, header=None, names=list(columns),
+            dtype={column: dtype for column, dtype in columns.items()
+                   if column not in dates}, engine='c')
+    except pd.errors.EmptyDataError:
+        return None
+    for column in dates:
+        df[column] = pd.to_datetime(df[column])
+    return df
+
+def _blocks(data, block_size):
+    """Read a binary file object in blocks of about `block_size` bytes, cut
+    after the last line break in each, so a line split across reads is
+    carried over to the next block."""
+    partial = b''
+    for block in iter(lambda: data.read(block_size), b''):
+        block = partial + block
+        end = block.rfind(b'\n') + 1
+        partial = block[end:]
+        if end:
+            yield block[:end]
+    if partial:
+        yield partial
+
+def _iter_c(data, table, block_size):
+    """Read a report a block at a time with pandas' C parser."""
+    for block in _blocks(data, block_size):
+        df = _read_c(io.BytesIO(block), table)
+        if df is not None:
+            yield df
+
+def iter_parse(data, table, remove_dupes=False,
+               block_size=config.DB_LOAD_BLOCK_SIZE):
+    """Parse a report into typed columns a block at a time, the streaming
+    equivalent of `parse`. Only one block of the report is held in memory at
+    once, however large the report is.
+
+    Args:
+        data (bytes or file-like): Contents of the report, or a binary file
+            object to read it from, e.g. `utils.open_s3_file`
+        table (str): Name of the table, one of `TABLES`
+        remove_dupes (:obj:`bool`, optional): Drop duplicate rows, across
+            blocks. Only a 64-bit hash of each distinct row is kept. Defaults
+            to False.
+        block_size (:obj:`int`, optional): Bytes of the report parsed at a
+            time. Defaults to `config.DB_LOAD_BLOCK_SIZE`.
+
+    Yields:
+        pandas.DataFrame: Rows of each block, with the column names and types
+        of the table
+    """
+    if isinstance(data, (bytes, bytearray)):
+        data = io.BytesIO(data)
+    if pyarrow is not None:
+        frames = _iter_arrow(data, table, block_size)
+    else:
+        frames = _iter_c(data, table, block_size)
+    seen = np.array([], dtype='uint64')
+    for df in frames:
+        if remove_dupes:
+            hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+            keep = np.zeros(len(df), dtype=bool)
+            keep[np.unique(hashes, return_index=True)[1]] = True
+            keep &= ~np.isin(hashes, seen)
+            seen = np.union1d(seen, hashes[keep])
+            df = df[keep].reset_index(drop=True)
+        if len(df):
+            yield df
+
+def parse(data, table, remove_dupes=False):
+    """Parse a report straight into typed columns, with pyarrow's multithreaded
+    CSV reader when pyarrow is installed, otherwise pandas' C parser.
+
+    Args:
+        data (bytes or file-like): Contents of the report, or a binary file
+            object to read it from, e.g. `utils.open_s3_file`
+        table (str): Name of the table, one of `TABLES`
+        remove_dupes (:obj:`bool`, optional): Drop duplicate rows. Defaults
+            to False.
+
+    Returns:
+        pandas.DataFrame: Rows with the column names and types of the table
+    """
+    if isinstance(data, (bytes, bytearray)):
+        data = io.BytesIO(data)
+    if pyarrow is not None:
+        df = _read_arrow(data, table)
+    else:
+        df = _read_c(data, table)
+    if df is None:
+        return to_frame([], table)
+    if remove_dupes:
+        df = df.drop_duplicates(ignore_index=True)
+    return df
+
+def to_copy_buffer(df):
+    """Write a DataFrame as tab separated text, for Postgres' ``COPY ...
+    FROM STDIN``.
+
+    Args:
+        df (pandas.DataFrame): Typed rows, see `parse`
+
+    Returns:
+        io.StringIO: Buffer positioned at its start
+    """
+    buf = io.StringIO()
+    df.to_csv(buf, sep='\t', header=False, index=False, na_rep='\\N')
+    buf.seek(0)
+    return buf
@@ -0,0 +1,180 @@
+"""
+Incrementally maintained summary of agent state transitions in the ftci
+table. For each agent, every pair of consecutive events is a transition, from
+the first event's code to the second's, that took the time between them.
+The ``ftci_summary`` table holds the count of each transition and the total
+time spent in it (in minutes), per agent.
+
+Rather than ranking the agent's whole history on every run, a refresh runs
+``LAG()`` over only the newly loaded rows, plus one carry-over row per agent:
+the last event already summarized, kept in ``ftci_summary_agents``. Refreshes
+run in the transaction that loads the rows, so their cost tracks the size of
+the load, not of the table.
+
+If rows arrive for an agent that are not later than its carry-over event,
+the agent's transitions are recomputed from its full history.
+
+Example:
+
+>>> from khp import db, summary
+>>> with db.connection() as conn, conn, conn.cursor() as cursor:
+...     summary.rebuild_ftci_summary(cursor)
+"""
+
+import logging
+
+from psycopg2.extras import execute_values
+
+LOGGER = logging.getLogger(__name__)
+
+CREATE_TABLES = """
+    CREATE TABLE IF NOT EXISTS ftci_summary (
+        agent_id INTEGER,
+        evt VARCHAR(50),
+        cnt INTEGER,
+        time_spent DECIMAL(12,2),
+        PRIMARY KEY (agent_id, evt)
+    );
+    CREATE TABLE IF NOT EXISTS ftci_summary_agents (
+        agent_id INTEGER PRIMARY KEY,
+        evt_cd_1 INTEGER,
+        evt_cd_2 INTEGER,
+        dt TIMESTAMP
+    );
+    CREATE TEMPORARY TABLE IF NOT EXISTS ftci_summary_bounds (
+        agent_id INTEGER PRIMARY KEY,
+        dt TIMESTAMP
+    ) ON COMMIT DELETE ROWS;
+    TRUNCATE ftci_summary_bounds;
+"""
+
+# rows of the agents being refreshed, from their earliest new event on. The
+# lower bound on all of them lets the scan use the index on dt.
+NEW_EVENTS = """
+    SELECT f.agent_id, f.evt_cd_1, f.evt_cd_2, f.dt
+    FROM ftci f
+    JOIN ftci_summary_bounds b ON b.agent_id = f.agent_id
+    WHERE f.dt >= b.dt
+    AND f.dt >= (SELECT min(dt) FROM ftci_summary_bounds)
+"""
+
+SUMMARIZE = """
+    INSERT INTO ftci_summary (agent_id, evt, cnt, time_spent)
+    SELECT agent_id, prev_evt || '-->' || evt, count(*), sum(delta)
+    FROM (
+        SELECT
+            agent_id,
+            LAG(evt_cd_1 || '-' || evt_cd_2) OVER w AS prev_evt,
+            evt_cd_1 || '-' || evt_cd_2 AS evt,
+            ROUND(CAST(EXTRACT(EPOCH FROM dt - LAG(dt) OVER w) / 60
+                       AS DECIMAL), 2) AS delta
+        FROM (
+            SELECT s.agent_id, s.evt_cd_1, s.evt_cd_2, s.dt
+            FROM ftci_summary_agents s
+            JOIN ftci_summary_bounds b ON b.agent_id = s.agent_id
+            UNION ALL
+            {new_events}
+        ) AS events
+        WINDOW w AS (PARTITION BY agent_id ORDER BY dt, evt_cd_1, evt_cd_2)
+    ) AS transitions
+    WHERE prev_evt IS NOT NULL
+    GROUP BY 1, 2
+    ON CONFLICT (agent_id, evt) DO UPDATE SET
+        cnt = ftci_summary.cnt + EXCLUDED.cnt,
+        time_spent = ftci_summary.time_spent + EXCLUDED.time_spent
+""".format(new_events=NEW_EVENTS)
+
+CARRY_OVER = """
+    INSERT INTO ftci_summary_agents (agent_id, evt_cd_1, evt_cd_2, dt)
+    SELECT DISTINCT ON (agent_id) agent_id, evt_cd_1, evt_cd_2, dt
+    FROM ({new_events}) AS events
+    ORDER BY agent_id, dt DESC, evt_cd_1 DESC, evt_cd_2 DESC
+    ON CONFLICT (agent_id) DO UPDATE SET
+        evt_cd_1 = EXCLUDED.evt_cd_1,
+        evt_cd_2 = EXCLUDED.evt_cd_2,
+        dt = EXCLUDED.dt
+""".format(new_events=NEW_EVENTS)
+
+def _create_tables(cursor):
+    """Create the summary tables if they do not exist.
+
+    Returns:
+        bool: Whether the summary has never been built. Every agent with
+        events in ftci has a carry-over row once it is, so this holds while
+        ``ftci_summary_agents`` is empty, whether or not the tables existed.
+    """
+    cursor.execute(CREATE_TABLES)
+    cursor.execute("SELECT NOT EXISTS (SELECT 1 FROM ftci_summary_agents)")
+    return cursor.fetchone()[0]
+
+def _summarize(cursor):
+    """Summarize the new events of the agents in ``ftci_summary_bounds``,
+    and move their carry-over rows to their last event.
+
+    Returns:
+        int: Number of transitions added or updated
+    """
+    cursor.execute(SUMMARIZE)
+    transitions = cursor.rowcount
+    cursor.execute(CARRY_OVER)
+    LOGGER.info("Refreshed ftci_summary for %s agents, %s transitions "
+                "updated", cursor.rowcount, transitions)
+    return transitions
+
+def rebuild_ftci_summary(cursor):
+    """Recompute the summary from the full history of every agent.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): Database cursor
+
+    Returns:
+        int: Number of transitions
+    """
+    _create_tables(cursor)
+    cursor.execute("TRUNCATE ftci_summary, ftci_summary_agents")
+    cursor.execute("INSERT INTO ftci_summary_bounds (agent_id, dt) "
+                   "SELECT DISTINCT agent_id, '-infinity'::timestamp "
+                   "FROM ftci")
+    return _summarize(cursor)
+
+def refresh_ftci_summary(cursor, df):
+    """Add newly loaded ftci rows to the summary. Call it in the transaction
+    that loads them, so the summary never misses or double counts rows.
+    Builds the summary from scratch while it has never been built, e.g. on
+    the first load after the tables are created.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): Database cursor
+        df (pandas.DataFrame): Rows just loaded into ftci, see
+            `khp.reports.parse`
+
+    Returns:
+        int: Number of transitions added or updated
+    """
+    if _create_tables(cursor):
+        return rebuild_ftci_summary(cursor)
+    if not len(df):
+        return 0
+    bounds = df.groupby('agent_id')['dt'].min()
+    execute_values(
+        cursor, "INSERT INTO ftci_summary_bounds (agent_id, dt) VALUES %s",
+        [(int(agent_id), dt.to_pydatetime())
+         for agent_id, dt in bounds.items()])
+
+    # agents with rows that are not later than their carry-over event are
+    # recomputed from the start
+    cursor.execute("""
+        DELETE FROM ftci_summary_agents s
+        USING ftci_summary_bounds b
+        WHERE s.agent_id = b.agent_id AND b.dt <= s.dt
+        RETURNING s.agent_id
+    """)
+    late = [row[0] for row in cursor.fetchall()]
+    if late:
+        LOGGER.warning("Rows loaded out of order for %s agents, recomputing "
+                       "their transitions", len(late))
+        cursor.execute("DELETE FROM ftci_summary WHERE agent_id = ANY(%s)",
+                       (late,))
+        cursor.execute("UPDATE ftci_summary_bounds SET dt = '-infinity' "
+                       "WHERE agent_id = ANY(%s)", (late,))
+    return _summarize(cursor)
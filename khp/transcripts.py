@@ -7,16 +7,15 @@ from datetime import timedelta, datetime
 import os
 import json
 
-import dask.bag as db
+import dask.bag
 from glom import glom, Coalesce, Call, T
-import postgrez
 
 from khp import transforms
 from khp import config
+from khp import db
 
 LOGGER = logging.getLogger(__name__)
 CONF = config.CONFIG
-DB_CONF = CONF['database']
 
 # initialize logging to file and stdout
 config.init_logging()
@@ -59,7 +58,7 @@ final_spec = {
 }
 
 path = os.path.join(config.ICESCAPE_OUTPUT_DIR, '*_data.txt')
-bag = db.read_text(path).map(json.loads)
+bag = dask.bag.read_text(path).map(json.loads)
 bag = bag.map(glom, base_spec)
 bag = bag.map(survey_response)
 bag = bag.map(glom, final_spec)
@@ -74,6 +73,4 @@ results = bag.compute()
 columns = list(results[0].keys())
 load_data = [[result[key] for key in columns] for result in results]
 
-postgrez.load(table_name="distress_scores", data=load_data, columns=columns,
-              host=DB_CONF['host'], user=DB_CONF['user'],
-              password=DB_CONF['pwd'], database=DB_CONF['db'])
+db.load(table_name="distress_scores", data=load_data, columns=columns)
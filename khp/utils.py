@@ -4,8 +4,15 @@ Contains utility functions used throughout the codebase.
 
 import logging
 import os
+import itertools
 import re
+import gzip
 import json
+import shutil
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, date
 
 import pytz
@@ -13,9 +20,29 @@ import dateutil.parser
 import pandas as pd
 import yaml
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 LOGGER = logging.getLogger(__name__)
 
+# size of each part sent in an S3 multipart upload, S3's minimum is 5 MB
+S3_PART_SIZE = 8 * 1024 * 1024
+
+# content encodings S3 objects can be compressed with
+COMPRESSIONS = ('gzip', 'zstd')
+
+# report dates in file names, e.g. V2_20181001_00001.txt, V1_201810011250.txt
+# (with a time) or V1_2018-10-01.txt
+REPORT_DATE_REGEX = re.compile(r'(?<!\d)(\d{4})[-_]?(\d{2})[-_]?(\d{2})')
+
+_S3_CLIENT = None
+_S3_CLIENT_LOCK = threading.Lock()
+
 def chunker(seq, chunk_size):
     """Break a list into a set of smaller lists with len = chunk_size
 
@@ -162,25 +189,251 @@ def read_yaml(yaml_file):
         LOGGER.error('Unable to read file %s.' % (yaml_file))
         raise
 
-def upload_to_s3(s3_bucket, files, encrypt=True):
-    """Upload a list of files to S3.
+def s3_client():
+    """Get the S3 client shared by the whole process. It is created on first
+    use, and (unlike boto3 resources) is safe to use from several threads, so
+    its connection pool is reused across uploads and reads.
+
+    Returns:
+        botocore.client.S3: S3 client
+    """
+    # khp.config imports this module, so it is imported on first use
+    from khp import config
+    global _S3_CLIENT
+    with _S3_CLIENT_LOCK:
+        if _S3_CLIENT is None:
+            _S3_CLIENT = boto3.client('s3', config=Config(
+                max_pool_connections=config.S3_MAX_POOL_CONNECTIONS))
+    return _S3_CLIENT
+
+def _upload_file(s3_bucket, f, key, encrypt, metadata, compression):
+    """Upload a single file to S3."""
+    if compression is not None:
+        with open(f, 'rb') as data, S3MultipartWriter(
+                s3_bucket, key, encrypt=encrypt, compression=compression,
+                metadata=metadata) as writer:
+            for block in iter(lambda: data.read(S3_PART_SIZE), b''):
+                writer.write(block)
+        return key
+    extra_args = {'Metadata': metadata or {}}
+    if encrypt:
+        extra_args['ServerSideEncryption'] = 'AES256'
+    # each worker sends its parts in sequence, so no more than one file per
+    # worker is open at once
+    transfer_config = TransferConfig(multipart_threshold=S3_PART_SIZE,
+                                     multipart_chunksize=S3_PART_SIZE,
+                                     use_threads=False)
+    s3_client().upload_file(f, s3_bucket, key, ExtraArgs=extra_args,
+                            Config=transfer_config)
+    return key
+
+def upload_to_s3(s3_bucket, files, encrypt=True, metadata=None,
+                 compression=None, max_workers=None, partitioned=False):
+    """Upload a list of files to S3, keyed as in `s3_key`. Files are
+    uploaded concurrently over the shared client in `s3_client`, and large
+    files are sent as multipart uploads. A failed upload is logged and
+    reported in the results, without stopping the rest of the batch.
 
     Args:
         s3_bucket (str): Name of the S3 bucket.
         files (list): List of files to upload
         encrypt (:obj:`bool`, optional): Use serverside AES256 encryption,
             defaults to True.
+        metadata (:obj:`dict`, optional): User metadata to store on each
+            object, keyed by file. Defaults to None.
+        compression (:obj:`str`, optional): Compress each file while it is
+            uploaded, with one of `COMPRESSIONS`. The object key is
+            unchanged, and `read_s3_file` decompresses it transparently.
+            Defaults to None.
+        max_workers (:obj:`int`, optional): Maximum number of files uploaded
+            at once. Defaults to `config.S3_UPLOAD_WORKERS`.
+        partitioned (:obj:`bool`, optional): Key files by report type and
+            date, see `s3_key`. Defaults to False.
+
+    Returns:
+        list: A dict for each file, in the order given, with the ``file``,
+        its ``key`` and the ``error`` raised uploading it (None on success)
     """
     LOGGER.info("Attempting to load {0} files to s3 bucket: {1}".format(
              len(files), s3_bucket))
-    s3 = boto3.resource('s3')
-    for f in files:
-        data = open(f, 'rb')
-        if encrypt:
-            s3.Bucket(s3_bucket).put_object(Key=os.path.basename(f), Body=data,
-                                            ServerSideEncryption='AES256')
+    metadata = metadata or {}
+    results = [{'file': f, 'key': s3_key(os.path.basename(f), partitioned),
+                'error': None} for f in files]
+
+    def upload(result):
+        try:
+            _upload_file(s3_bucket, result['file'], result['key'], encrypt,
+                         metadata.get(result['file']), compression)
+        except Exception as err:
+            LOGGER.error("Failed to upload %s to S3 bucket %s: %s",
+                         result['file'], s3_bucket, err)
+            result['error'] = err
+
+    if max_workers is None:
+        from khp import config
+        max_workers = config.S3_UPLOAD_WORKERS
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        list(executor.map(upload, results))
+
+    failed = sum(1 for result in results if result['error'] is not None)
+    LOGGER.info("Uploaded {0} of {1} files to s3 bucket: {2}".format(
+        len(files) - failed, len(files), s3_bucket))
+    return results
+
+def _compressor(compression):
+    """Create a streaming compressor, with `compress` and `flush` methods."""
+    if compression == 'gzip':
+        return zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError("Unsupported compression {}, expected one of {}".format(
+        compression, COMPRESSIONS))
+
+def _decompressor(compression):
+    """Create a streaming decompressor, with `decompress` and `flush`
+    methods."""
+    if compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstd compression requires the zstandard package")
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError("Unsupported compression {}, expected one of {}".format(
+        compression, COMPRESSIONS))
+
+def decompress(data, compression):
+    """Decompress data compressed with one of `COMPRESSIONS`.
+
+    Args:
+        data (bytes): Compressed data
+        compression (str): Compression the data was encoded with
+
+    Returns:
+        bytes: Decompressed data
+    """
+    decompressor = _decompressor(compression)
+    return decompressor.decompress(data) + decompressor.flush()
+
+class S3MultipartWriter():
+    """File-like object that streams written bytes into an S3 object using a
+    multipart upload. At most `part_size` bytes are buffered in memory at any
+    time. Objects smaller than a single part are sent with one `put_object`
+    call instead.
+
+    Data can optionally be compressed on the way through, in which case the
+    object's `ContentEncoding` is set so `read_s3_file` can decompress it.
+
+    Use as a context manager: the upload is completed when the block exits
+    cleanly, and aborted if it raises.
+
+    Attributes:
+        s3_bucket (str): Name of the S3 bucket
+        key (str): Key of the S3 object being written
+        part_size (int): Size of each uploaded part, in bytes. S3 requires
+            every part but the last to be at least 5 MB.
+        metadata (dict): User metadata to store on the object
+        size (int): Total number of (uncompressed) bytes written so far
+    """
+
+    def __init__(self, s3_bucket, key, part_size=S3_PART_SIZE, encrypt=True,
+                 client=None, compression=None, metadata=None):
+        self.s3_bucket = s3_bucket
+        self.key = key
+        self.part_size = part_size
+        self.metadata = metadata or {}
+        self.size = 0
+        self._client = client or s3_client()
+        self._extra_args = {'ServerSideEncryption': 'AES256'} if encrypt else {}
+        self._compressor = None
+        if compression is not None:
+            self._compressor = _compressor(compression)
+            self._extra_args['ContentEncoding'] = compression
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, data):
+        """Buffer data, uploading a part each time `part_size` bytes have
+        accumulated.
+
+        Args:
+            data (bytes-like): Data to write, copied into the buffer
+        """
+        self.size += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._buffer += data
+        self._flush_parts()
+
+    def _flush_parts(self):
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+
+    def _upload_part(self, data):
+        if self._upload_id is None:
+            response = self._client.create_multipart_upload(
+                Bucket=self.s3_bucket, Key=self.key, Metadata=self.metadata,
+                **self._extra_args)
+            self._upload_id = response['UploadId']
+        part_number = len(self._parts) + 1
+        response = self._client.upload_part(
+            Bucket=self.s3_bucket, Key=self.key, UploadId=self._upload_id,
+            PartNumber=part_number, Body=bytes(data))
+        self._parts.append({'ETag': response['ETag'],
+                            'PartNumber': part_number})
+
+    def close(self, metadata=None):
+        """Upload any buffered data and complete the upload.
+
+        Args:
+            metadata (:obj:`dict`, optional): Extra user metadata that is only
+                known once all the data is written. For a multipart upload it
+                is applied by copying the object onto itself.
+        """
+        if self._compressor is not None:
+            self._buffer += self._compressor.flush()
+            self._flush_parts()
+        if metadata:
+            self.metadata = dict(self.metadata, **metadata)
+        if self._upload_id is None:
+            self._client.put_object(Bucket=self.s3_bucket, Key=self.key,
+                                    Body=bytes(self._buffer),
+                                    Metadata=self.metadata,
+                                    **self._extra_args)
+        else:
+            if self._buffer:
+                self._upload_part(self._buffer)
+            self._client.complete_multipart_upload(
+                Bucket=self.s3_bucket, Key=self.key, UploadId=self._upload_id,
+                MultipartUpload={'Parts': self._parts})
+            if metadata:
+                self._client.copy_object(
+                    Bucket=self.s3_bucket, Key=self.key,
+                    CopySource={'Bucket': self.s3_bucket, 'Key': self.key},
+                    Metadata=self.metadata, MetadataDirective='REPLACE',
+                    **self._extra_args)
+        self._buffer = bytearray()
+
+    def abort(self):
+        """Abort the upload, discarding any parts already sent."""
+        LOGGER.warning("Aborting upload of %s to S3 bucket %s", self.key,
+                       self.s3_bucket)
+        if self._upload_id is not None:
+            self._client.abort_multipart_upload(
+                Bucket=self.s3_bucket, Key=self.key, UploadId=self._upload_id)
+        self._buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, exc_tb):
+        if exc_type is None:
+            self.close()
         else:
-            s3.Bucket(s3_bucket).put_object(Key=os.path.basename(f), Body=data)
+            self.abort()
 
 def get_s3_keys(s3_bucket, prefix=None):
     """Get a list of keys in an S3 bucket. Optionally specify a prefix to
@@ -193,35 +446,185 @@ def get_s3_keys(s3_bucket, prefix=None):
         list: List of keys in the S3 bucket.
     """
     keys = []
-    s3 = boto3.client('s3')
-
-    paginator = s3.get_paginator('list_objects_v2')
+    paginator = s3_client().get_paginator('list_objects_v2')
     filters = {'Bucket': s3_bucket}
     if prefix is not None:
         filters['Prefix'] = prefix
     page_iterator = paginator.paginate(**filters)
 
     for page in page_iterator:
-        for obj in page['Contents']:
+        for obj in page.get('Contents', []):
             keys.append(obj['Key'])
     return keys
 
-def read_s3_file(s3_bucket, key):
-    """Read the contents of an S3 object.
+def report_date(filename):
+    """Get the report date from a file name, the first ``YYYYMMDD`` or
+    ``YYYY-MM-DD`` date in it. The date may be followed directly by a time,
+    as in ``V1_201810011250.txt``.
+
+    Args:
+        filename (str): Name of the report
+
+    Returns:
+        datetime.date: Date of the report, or None if the name has no date
+    """
+    for match in REPORT_DATE_REGEX.finditer(filename):
+        try:
+            return date(*[int(part) for part in match.groups()])
+        except ValueError:
+            continue
+    return None
+
+def partition_prefix(report_type, dt):
+    """Get the S3 key prefix of a partition of reports.
+
+    Args:
+        report_type (str): Type of the report, the start of its name, e.g. V2
+        dt (datetime.date): Date of the partition
+
+    Returns:
+        str: Key prefix, e.g. ``V2/2018/10/01/``
+    """
+    return '{0}/{1:%Y}/{1:%m}/{1:%d}/'.format(report_type, dt)
+
+def s3_key(filename, partitioned=False):
+    """Get the S3 key of a report. By default reports are stored at the root
+    of the bucket. When partitioned, they are stored under their type (the
+    part of the name before the first underscore) and date, so listings can
+    be bounded to a date window with `get_s3_keys_between`. Reports without a
+    date in their name stay at the root.
+
+    Args:
+        filename (str): Name of the report
+        partitioned (:obj:`bool`, optional): Use the partitioned layout.
+            Defaults to False.
+
+    Returns:
+        str: S3 key, e.g. ``V2/2018/10/01/V2_20181001_00001.txt``
+    """
+    if not partitioned:
+        return filename
+    dt = report_date(filename)
+    if dt is None:
+        LOGGER.debug("No date found in %s, keying it by name", filename)
+        return filename
+    return partition_prefix(filename.split('_')[0], dt) + filename
+
+def get_s3_keys_between(s3_bucket, report_type, start_date, end_date):
+    """Get the keys of reports of a type dated between two dates, from a
+    bucket using the partitioned layout of `s3_key`. Only the partitions for
+    each day in the window are listed.
+
+    Args:
+        s3_bucket (str): Name of the S3 bucket.
+        report_type (str): Type of the report, e.g. V2
+        start_date (str): Start date, `YYYY-mm-dd`
+        end_date (str): End date, `YYYY-mm-dd`
+
+    Returns:
+        list: List of keys in the date window.
+    """
+    keys = []
+    for dt in generate_date_range(start_date, end_date):
+        keys.extend(get_s3_keys(s3_bucket,
+                                prefix=partition_prefix(report_type, dt)))
+    return keys
+
+def read_s3_bytes(s3_bucket, key):
+    """Read the raw contents of an S3 object, decompressing it if it was
+    uploaded with compression.
 
     Args:
         s3_bucket (str): Name of the S3 bucket.
         key (str): Name of the S3 object
 
     Returns:
-        str: Contents of S3 object
+        bytes: Contents of S3 object
     """
     LOGGER.info("Reading {0} from S3 bucket: {1}".format(key, s3_bucket))
-    s3 = boto3.resource('s3')
-    obj = s3.Object(s3_bucket, key)
-    contents = obj.get()['Body'].read().decode('utf-8')
+    response = s3_client().get_object(Bucket=s3_bucket, Key=key)
+    contents = response['Body'].read()
+    compression = response.get('ContentEncoding')
+    if compression in COMPRESSIONS:
+        contents = decompress(contents, compression)
     return contents
 
+def read_s3_file(s3_bucket, key):
+    """Read the contents of an S3 object, decompressing it if it was uploaded
+    with compression.
+
+    Args:
+        s3_bucket (str): Name of the S3 bucket.
+        key (str): Name of the S3 object
+
+    Returns:
+        str: Contents of S3 object
+    """
+    return read_s3_bytes(s3_bucket, key).decode('utf-8')
+
+def open_s3_file(s3_bucket, key):
+    """Open an S3 object as a binary file object that streams its body,
+    decompressing it on the fly if it was uploaded with compression.
+
+    Args:
+        s3_bucket (str): Name of the S3 bucket.
+        key (str): Name of the S3 object
+
+    Returns:
+        file-like: Object with a `read` method returning the contents
+    """
+    LOGGER.info("Streaming {0} from S3 bucket: {1}".format(key, s3_bucket))
+    response = s3_client().get_object(Bucket=s3_bucket, Key=key)
+    body = response['Body']
+    compression = response.get('ContentEncoding')
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=body)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstd compression requires the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(body)
+    return body
+
+def prefetch(func, items, depth=None, max_workers=None):
+    """Map a function over items on a thread pool, running ahead of the
+    consumer. At most `depth` results are in flight or waiting to be
+    consumed at once, so I/O bound work (like reading S3 objects) overlaps
+    with whatever the consumer does with each result, with bounded memory.
+
+    Args:
+        func (function): Called with each item
+        items (iterable): Items to process
+        depth (:obj:`int`, optional): Maximum number of items processed ahead
+            of the consumer. Defaults to `config.S3_PREFETCH_DEPTH`.
+        max_workers (:obj:`int`, optional): Number of threads. Defaults to
+            `depth`.
+
+    Yields:
+        tuple: Each item and its result, in the order of `items`. If `func`
+        raised, the exception is raised when that item is reached.
+    """
+    if depth is None:
+        from khp import config
+        depth = config.S3_PREFETCH_DEPTH
+    depth = max(1, depth)
+    items = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers or depth) as executor:
+        try:
+            for item in itertools.islice(items, depth):
+                pending.append((item, executor.submit(func, item)))
+            while pending:
+                item, future = pending.popleft()
+                result = future.result()
+                for next_item in itertools.islice(items, 1):
+                    pending.append((next_item,
+                                    executor.submit(func, next_item)))
+                yield item, result
+        finally:
+            # don't wait on prefetched items the consumer will never see
+            for _, future in pending:
+                future.cancel()
+
 def parse_s3_contents(contents, delimiter, remove_dupes=False,
                         skip_first_line=False):
     """Read the contents of an S3 object into a list of lists.
@@ -240,7 +643,6 @@ def parse_s3_contents(contents, delimiter, remove_dupes=False,
     lines = [line for line in contents.split('\r\n') if line != '']
     if remove_dupes:
         lines = list(set(lines))
-        print (lines)
     parsed_contents = [line.split(delimiter) for line in lines]
     if skip_first_line:
         parsed_contents = parsed_contents[1:]
@@ -275,13 +677,15 @@ def search_path(path, like=None):
     LOGGER.info("Found %s files in %s", len(files), path)
     return files
 
-def clean_dir(path, prefix=None):
+def clean_dir(path, prefix=None, exclude=None):
     """Helper function to clear any folders and files in a specified path.
 
     Args:
         path (str): input path
         prefix (:obj:`str`, optional): File prefix
+        exclude (:obj:`list`, optional): Paths of files to keep
     """
+    exclude = set(exclude or [])
 
     LOGGER.info("Cleaning folders in %s" % path)
     for p in os.listdir(path):
@@ -295,6 +699,8 @@ def clean_dir(path, prefix=None):
             basename = os.path.basename(fullPath)
             if prefix is not None:
                 prefix_check = basename.startswith(prefix)
+            if fullPath in exclude:
+                continue
             if prefix_check and basename.startswith('.') == False:
                 os.remove(fullPath)
                 assert not os.path.isfile(fullPath)